@@ -0,0 +1,238 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : annotation.py
+#   Author      : YunYang1994
+#   Created date: 2019-03-27 11:20:36
+#   Description : compiled binary index of an annotation txt
+#
+#================================================================
+"""
+The annotation txt is compiled once into a directory of .npy arrays
+
+    paths.npy         (P,)    uint8  the utf-8 image paths concatenated back to back
+    path_offsets.npy  (N+1,)  int64  path of line i is paths[path_offsets[i]:path_offsets[i+1]]
+    boxes.npy         (M, 5)  int32  xmin, ymin, xmax, ymax, class_id of all lines
+    box_offsets.npy   (N+1,)  int64  boxes of line i are boxes[box_offsets[i]:box_offsets[i+1]]
+    sizes.npy         (N, 2)  int32  optional, (height, width) of the image of line i, written by core.validate
+    source.npy        (2,)    int64  size and mtime of the txt, the index is rebuilt when they change
+
+which are memory mapped, so an index of millions of lines holds no python strings.
+For datasets too large to compile up front, AnnotationStream reads the txt lazily instead.
+By default the index of ./data/dataset/voc_train.txt lives in ./data/dataset/voc_train.txt.index
+and is built on first use, or ahead of time with
+
+    $ python -m core.annotation --annot_path ./data/dataset/voc_train.txt
+"""
+
+import os
+import argparse
+import tempfile
+import numpy as np
+
+
+INDEX_FILES = ['paths', 'path_offsets', 'boxes', 'box_offsets']
+
+
+def parse_annotation_line(line):
+
+    line = line.split()
+    bboxes = np.array([list(map(lambda x: int(float(x)), box.split(','))) for box in line[1:]], dtype=np.int32)
+    return line[0], bboxes.reshape(-1, 5)
+
+
+def default_index_dir(annot_path):
+    return annot_path + '.index'
+
+
+def source_stamp(annot_path):
+    stat = os.stat(annot_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def temporary_path(path):
+    """a new file next to `path`, to write it under another name first"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    # mkstemp files are private to their owner, the index is not
+    os.chmod(tmp_path, 0o644)
+    return tmp_path
+
+
+def save_array(path, array):
+    """
+    np.save through a temporary file renamed over `path`. another process (e.g. a trainer of another rank)
+    which has the old file memory mapped keeps reading the old one, instead of a file truncated under it
+    """
+    tmp_path = temporary_path(path)
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def compile_annotations(annot_path, index_dir=None, sizes=None):
+    """
+    parse every line of the annotation txt once and save the index, lines without boxes are kept.
+    the (height, width) `sizes` of the images of the lines are saved with it when given.
+    several processes may compile the same txt at once, every file is replaced as a whole
+    """
+    index_dir = default_index_dir(annot_path) if index_dir is None else index_dir
+    os.makedirs(index_dir, exist_ok=True)
+    sizes_path = os.path.join(index_dir, 'sizes.npy')
+    try:
+        os.remove(sizes_path)
+    except OSError:
+        pass
+
+    paths, path_offsets, boxes, box_offsets = [], [0], [], [0]
+    with open(annot_path, 'r') as f:
+        for line in f:
+            if len(line.strip()) == 0: continue
+            image_path, bboxes = parse_annotation_line(line)
+            image_path = image_path.encode('utf-8')
+            paths.append(image_path)
+            path_offsets.append(path_offsets[-1] + len(image_path))
+            boxes.append(bboxes)
+            box_offsets.append(box_offsets[-1] + len(bboxes))
+
+    arrays = {'paths':        np.frombuffer(b''.join(paths), dtype=np.uint8),
+              'path_offsets': np.array(path_offsets, dtype=np.int64),
+              'boxes':        np.concatenate(boxes + [np.zeros((0, 5), dtype=np.int32)], axis=0).astype(np.int32),
+              'box_offsets':  np.array(box_offsets, dtype=np.int64)}
+    for name in INDEX_FILES:
+        save_array(os.path.join(index_dir, name + '.npy'), arrays[name])
+    if sizes is not None:
+        assert len(sizes) == len(paths), "one image size per annotation line"
+        save_array(sizes_path, np.array(sizes, dtype=np.int32).reshape(-1, 2))
+    # written last, an interrupted compile leaves no valid stamp behind
+    save_array(os.path.join(index_dir, 'source.npy'), source_stamp(annot_path))
+    return len(paths)
+
+
+def load_annotation_index(annot_path, index_dir=None):
+    """open the index of an annotation txt, compiling it first when it is missing or out of date"""
+    index_dir = default_index_dir(annot_path) if index_dir is None else index_dir
+    source_path = os.path.join(index_dir, 'source.npy')
+    if not os.path.exists(source_path) or not np.array_equal(np.load(source_path), source_stamp(annot_path)):
+        print('=> compile the annotation index of %s' % annot_path)
+        compile_annotations(annot_path, index_dir)
+    return AnnotationIndex(index_dir)
+
+
+class AnnotationIndex(object):
+    """
+    memory mapped annotation index, the arrays are mapped on first use and in every process
+    that unpickles the index.
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.arrays    = None
+        self.num_lines = len(np.load(os.path.join(index_dir, 'path_offsets.npy'), mmap_mode='r')) - 1
+        self.has_sizes = os.path.exists(os.path.join(index_dir, 'sizes.npy'))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __len__(self):
+        return self.num_lines
+
+    def load(self):
+        if self.arrays is None:
+            self.arrays = {name: np.load(os.path.join(self.index_dir, name + '.npy'), mmap_mode='r')
+                           for name in INDEX_FILES + (['sizes'] if self.has_sizes else [])}
+        return self.arrays
+
+    def num_bboxes(self):
+        return np.diff(self.load()['box_offsets'])
+
+    def path(self, index):
+
+        arrays = self.load()
+        start, end = arrays['path_offsets'][index], arrays['path_offsets'][index + 1]
+        return arrays['paths'][start:end].tobytes().decode('utf-8')
+
+    def bboxes(self, index):
+
+        arrays = self.load()
+        start, end = arrays['box_offsets'][index], arrays['box_offsets'][index + 1]
+        return np.array(arrays['boxes'][start:end])
+
+    def all_bboxes(self):
+        return self.load()['boxes']
+
+    def image_size(self, index):
+        """(height, width) of the image of line `index`, only for an index with sizes"""
+        return tuple(int(size) for size in self.load()['sizes'][index])
+
+
+def count_lines(annot_path, chunk_bytes=1 << 24):
+    """number of lines of a file, counted chunk by chunk without decoding them"""
+    num_lines, last = 0, b'\n'
+    with open(annot_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_bytes), b''):
+            num_lines += chunk.count(b'\n')
+            last = chunk[-1:]
+    return num_lines + (last != b'\n')
+
+
+class AnnotationStream(object):
+    """
+    stream the (image_path, bboxes) annotations of a txt in a new random order on every pass, with memory
+    bounded by `buffer_size` annotations: the file is read in blocks of about `block_bytes` in a random
+    block order and the lines go through a shuffle buffer. lines without any box are skipped.
+    len() is the number of lines of the txt, so it counts the lines without boxes too.
+    """
+    def __init__(self, annot_path, block_bytes=1 << 20, buffer_size=10000):
+        self.annot_path  = annot_path
+        self.block_bytes = block_bytes
+        self.buffer_size = max(buffer_size, 1)
+        self.file_bytes  = os.path.getsize(annot_path)
+        self.num_blocks  = max(-(-self.file_bytes // block_bytes), 1)
+        self.num_lines   = count_lines(annot_path)
+
+    def __len__(self):
+        return self.num_lines
+
+    def read_block(self, f, block):
+        """the lines starting inside the block, the line crossing its start belongs to the block before"""
+        start, end = block * self.block_bytes, (block + 1) * self.block_bytes
+        f.seek(max(start - 1, 0))
+        if start > 0: f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line: break
+            yield line.decode('utf-8')
+
+    def iterate(self, rng):
+
+        buffer = []
+        with open(self.annot_path, 'rb') as f:
+            for block in rng.permutation(self.num_blocks):
+                for line in self.read_block(f, block):
+                    if len(line.split()) < 2: continue
+                    annotation = parse_annotation_line(line)
+                    if len(buffer) < self.buffer_size:
+                        buffer.append(annotation)
+                        continue
+                    index = rng.randint(self.buffer_size)
+                    yield buffer[index]
+                    buffer[index] = annotation
+        rng.shuffle(buffer)
+        for annotation in buffer:
+            yield annotation
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annot_path", default="./data/dataset/voc_train.txt")
+    parser.add_argument("--index_dir", default=None, help="default: <annot_path>.index")
+    flags = parser.parse_args()
+
+    num_lines = compile_annotations(flags.annot_path, flags.index_dir)
+    print('=> %d annotations indexed in %s' % (num_lines, flags.index_dir or default_index_dir(flags.annot_path)))
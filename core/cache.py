@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : cache.py
+#   Author      : YunYang1994
+#   Created date: 2019-03-25 09:47:15
+#   Description : decoded image cache for core.dataset
+#
+#================================================================
+
+import ctypes
+import hashlib
+import numpy as np
+import multiprocessing as mp
+from collections import OrderedDict
+
+
+class ImageCache(object):
+    """
+    least recently used cache of decoded images, bounded by the total bytes of the cached arrays.
+    every image is cached with a small `info` object, e.g. the scale it was decoded at.
+    cached images are read only, callers have to copy them before modifying.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.images    = OrderedDict()
+        self.hits      = 0
+        self.misses    = 0
+
+    def __len__(self):
+        return len(self.images)
+
+    def get(self, key):
+
+        entry = self.images.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.images.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, image, info=None):
+        """cache the image and return the (image, info) entry"""
+        if image.nbytes > self.max_bytes or key in self.images: return image, info
+        image.flags.writeable = False
+        self.images[key] = (image, info)
+        self.num_bytes += image.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, (evicted, _) = self.images.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+        return image, info
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def report(self):
+        return "image cache: %d images, %.1f MB, hit rate %.2f%% (%d hits, %d misses)" % (
+                len(self.images), self.num_bytes / 2.**20, 100. * self.hit_rate(), self.hits, self.misses)
+
+
+def key_hash(key):
+    """stable non zero 63 bit hash of a cache key, the same in every process"""
+    digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest()
+    return (int.from_bytes(digest, 'little') >> 1) | 1
+
+
+class SharedImageCache(object):
+    """
+    decoded image cache of the prefetch workers, one arena of shared memory of max_bytes allocated up front,
+    whatever the number of workers. images are added until the arena or the table of max_images entries is
+    full and never evicted, so the cached views stay valid. with shuffled epochs this hits as often as a least
+    recently used cache of the same size. `info` is the (y, x) scale the image was decoded at.
+    cached images are read only, callers have to copy them before modifying.
+    """
+    def __init__(self, max_bytes, max_images):
+        self.max_bytes  = max_bytes
+        self.max_images = max_images
+        self.num_slots  = 2 * max_images + 1
+        self.lock       = mp.Lock()
+        self.arena      = mp.RawArray(ctypes.c_uint8, max_bytes)
+        # per slot: key hash (0 for a free slot), offset in the arena, height, width, channels
+        self.slots      = mp.RawArray(ctypes.c_int64, self.num_slots * 5)
+        self.scales     = mp.RawArray(ctypes.c_double, self.num_slots * 2)
+        # used bytes, number of images, hits, misses
+        self.counters   = mp.RawArray(ctypes.c_int64, 4)
+        self.views      = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['views'] = None
+        return state
+
+    def __len__(self):
+        return int(self.counters[1])
+
+    def arrays(self):
+        if self.views is None:
+            self.views = (np.frombuffer(self.arena, dtype=np.uint8),
+                          np.frombuffer(self.slots, dtype=np.int64).reshape(self.num_slots, 5),
+                          np.frombuffer(self.scales, dtype=np.float64).reshape(self.num_slots, 2),
+                          np.frombuffer(self.counters, dtype=np.int64))
+        return self.views
+
+    def find(self, slots, key):
+        """the slot of `key`, or the free slot it would go to"""
+        num = key % self.num_slots
+        while slots[num, 0] != 0 and slots[num, 0] != key:
+            num = (num + 1) % self.num_slots
+        return num
+
+    def entry(self, num):
+
+        arena, slots, scales, _ = self.arrays()
+        offset, shape = slots[num, 1], tuple(slots[num, 2:5])
+        image = arena[offset:offset + int(np.prod(shape))].reshape(shape)
+        image.flags.writeable = False
+        return image, (scales[num, 0], scales[num, 1])
+
+    def get(self, key):
+
+        key = key_hash(key)
+        _, slots, _, counters = self.arrays()
+        with self.lock:
+            num = self.find(slots, key)
+            found = slots[num, 0] == key
+            counters[2 if found else 3] += 1
+        return self.entry(num) if found else None
+
+    def put(self, key, image, info=(1.0, 1.0)):
+        """cache the image, unless it does not fit anymore, and return the (image, info) entry"""
+        key = key_hash(key)
+        arena, slots, scales, counters = self.arrays()
+        if image.dtype != np.uint8 or image.ndim != 3: return image, info
+        with self.lock:
+            num = self.find(slots, key)
+            if slots[num, 0] == key:
+                # decoded by another worker in the meantime
+                return self.entry(num)
+            offset = counters[0]
+            if offset + image.nbytes > self.max_bytes or counters[1] >= self.max_images:
+                return image, info
+            arena[offset:offset + image.nbytes] = image.reshape(-1)
+            slots[num, 1:] = [offset] + list(image.shape)
+            scales[num] = info
+            slots[num, 0] = key
+            counters[0] += image.nbytes
+            counters[1] += 1
+        return self.entry(num)
+
+    def hit_rate(self):
+        return self.counters[2] / max(self.counters[2] + self.counters[3], 1)
+
+    def report(self):
+        return "shared image cache: %d images, %.1f MB, hit rate %.2f%% (%d hits, %d misses)" % (
+                len(self), self.counters[0] / 2.**20, 100. * self.hit_rate(), self.counters[2], self.counters[3])
@@ -14,6 +14,28 @@
 import tensorflow as tf
 
 
+# passed as `trainable` to build the inference only graph of fold_batchnorm.py: every batch normalization
+# is folded into the weight and a bias of its convolution, and there are no training branches left
+FOLDED_BN = 'folded_bn'
+
+
+def folded_bias(input_c, dtype=tf.float32):
+    return tf.get_variable(name='bias', shape=input_c, dtype=dtype, trainable=False,
+                           initializer=tf.zeros_initializer())
+
+
+def float32_variable_getter(getter, name, shape=None, dtype=None, *args, **kwargs):
+    """
+    custom getter of the half precision network: a variable asked for in float16 or bfloat16 is stored
+    as a float32 master weight, under the same name as in a float32 network, and cast when it is read
+    """
+    storage_dtype = tf.float32 if dtype in [tf.float16, tf.bfloat16] else dtype
+    variable = getter(name, shape, dtype=storage_dtype, *args, **kwargs)
+    if storage_dtype != dtype:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+
 def convolutional(input_data, filters_shape, trainable, name, downsample=False, activate=True, bn=True):
 
     with tf.variable_scope(name):
@@ -27,11 +49,13 @@ def convolutional(input_data, filters_shape, trainable, name, downsample=False,
             strides = (1, 1, 1, 1)
             padding = "SAME"
 
-        weight = tf.get_variable(name='weight', dtype=tf.float32, trainable=True,
+        weight = tf.get_variable(name='weight', dtype=input_data.dtype, trainable=True,
                                  shape=filters_shape, initializer=tf.random_normal_initializer(stddev=0.01))
         conv = tf.nn.conv2d(input=input_data, filter=weight, strides=strides, padding=padding)
 
-        if bn:
+        if bn and trainable is FOLDED_BN:
+            conv = tf.nn.bias_add(conv, folded_bias(filters_shape[-1], conv.dtype))
+        elif bn:
             conv = tf.layers.batch_normalization(conv, beta_initializer=tf.zeros_initializer(),
                                                  gamma_initializer=tf.ones_initializer(),
                                                  moving_mean_initializer=tf.zeros_initializer(),
@@ -39,7 +63,7 @@ def convolutional(input_data, filters_shape, trainable, name, downsample=False,
             # conv = group_normalization(input_data=conv, input_channel=filters_shape[-1])
         else:
             bias = tf.get_variable(name='bias', shape=filters_shape[-1], trainable=True,
-                                   dtype=tf.float32, initializer=tf.constant_initializer(0.0))
+                                   dtype=conv.dtype, initializer=tf.constant_initializer(0.0))
             conv = tf.nn.bias_add(conv, bias)
 
         if activate == True: conv = tf.nn.leaky_relu(conv, alpha=0.1)
@@ -75,7 +99,7 @@ def inverted_residual(name, input_data, input_c, output_c, trainable, downsample
 
         with tf.variable_scope('expand'):
             if t > 1:
-                expand_weight = tf.get_variable(name='weights', dtype=tf.float32, trainable=True,
+                expand_weight = tf.get_variable(name='weights', dtype=input_data.dtype, trainable=True,
                                                 shape=(1, 1, input_c, expand_c),
                                                 initializer=tf.random_normal_initializer(stddev=0.01))
                 expand_conv = tf.nn.conv2d(input=input_data, filter=expand_weight, strides=(1, 1, 1, 1), padding="SAME")
@@ -93,7 +117,7 @@ def inverted_residual(name, input_data, input_c, output_c, trainable, downsample
             else:
                 strides = (1, 1, 1, 1)
                 padding = "SAME"
-            dwise_weight = tf.get_variable(name='depthwise_weights', dtype=tf.float32, trainable=True,
+            dwise_weight = tf.get_variable(name='depthwise_weights', dtype=input_data.dtype, trainable=True,
                                            shape=(3, 3, expand_c, 1),
                                            initializer=tf.random_normal_initializer(stddev=0.01))
             dwise_conv = tf.nn.depthwise_conv2d(input=expand_conv, filter=dwise_weight, strides=strides, padding=padding)
@@ -101,7 +125,7 @@ def inverted_residual(name, input_data, input_c, output_c, trainable, downsample
             dwise_conv = tf.nn.relu6(dwise_conv)
 
         with tf.variable_scope('project'):
-            pwise_weight = tf.get_variable(name='weights', dtype=tf.float32, trainable=True,
+            pwise_weight = tf.get_variable(name='weights', dtype=input_data.dtype, trainable=True,
                                            shape=(1, 1, expand_c, output_c),
                                            initializer=tf.random_normal_initializer(stddev=0.01))
             pwise_conv = tf.nn.conv2d(input=dwise_conv, filter=pwise_weight, strides=(1, 1, 1, 1), padding="SAME")
@@ -123,7 +147,7 @@ def separable_conv(name, input_data, input_c, output_c, trainable, downsample=Fa
             else:
                 strides = (1, 1, 1, 1)
                 padding = "SAME"
-            dwise_weight = tf.get_variable(name='depthwise_weights', dtype=tf.float32, trainable=True,
+            dwise_weight = tf.get_variable(name='depthwise_weights', dtype=input_data.dtype, trainable=True,
                                            shape=(3, 3, input_c, 1),
                                            initializer=tf.random_normal_initializer(stddev=0.01))
             dwise_conv = tf.nn.depthwise_conv2d(input=input_data, filter=dwise_weight, strides=strides, padding=padding)
@@ -131,7 +155,7 @@ def separable_conv(name, input_data, input_c, output_c, trainable, downsample=Fa
             dwise_conv = tf.nn.relu6(dwise_conv)
 
         with tf.variable_scope('pointwise'):
-            pwise_weight = tf.get_variable(name='pointwise_weights', dtype=tf.float32, trainable=True,
+            pwise_weight = tf.get_variable(name='pointwise_weights', dtype=input_data.dtype, trainable=True,
                                            shape=(1, 1, input_c, output_c),
                                            initializer=tf.random_normal_initializer(stddev=0.01))
             pwise_conv = tf.nn.conv2d(input=dwise_conv, filter=pwise_weight, strides=(1, 1, 1, 1), padding="SAME")
@@ -141,10 +165,14 @@ def separable_conv(name, input_data, input_c, output_c, trainable, downsample=Fa
 
 def batch_normalization(input_data, input_c, trainable, decay=0.9):
 
+    if trainable is FOLDED_BN:
+        return tf.nn.bias_add(input_data, folded_bias(input_c, input_data.dtype))
+
+    # the moving statistics are float32 in every precision, the batch statistics are computed in float32 too
     with tf.variable_scope('BatchNorm'):
-        gamma = tf.get_variable(name='gamma', shape=input_c, dtype=tf.float32,
+        gamma = tf.get_variable(name='gamma', shape=input_c, dtype=input_data.dtype,
                                 initializer=tf.ones_initializer, trainable=True)
-        beta = tf.get_variable(name='beta', shape=input_c, dtype=tf.float32,
+        beta = tf.get_variable(name='beta', shape=input_c, dtype=input_data.dtype,
                                initializer=tf.zeros_initializer, trainable=True)
         moving_mean = tf.get_variable(name='moving_mean', shape=input_c, dtype=tf.float32,
                                       initializer=tf.zeros_initializer, trainable=False)
@@ -153,14 +181,20 @@ def batch_normalization(input_data, input_c, trainable, decay=0.9):
 
         def mean_and_var_update():
             axes = (0, 1, 2)
-            batch_mean = tf.reduce_mean(input_data, axis=axes)
-            batch_var = tf.reduce_mean(tf.pow(input_data - batch_mean, 2), axis=axes)
+            float_data = tf.cast(input_data, tf.float32)
+            batch_mean = tf.reduce_mean(float_data, axis=axes)
+            batch_var = tf.reduce_mean(tf.pow(float_data - batch_mean, 2), axis=axes)
             with tf.control_dependencies([tf.assign(moving_mean, moving_mean * decay + batch_mean * (1 - decay)),
                                           tf.assign(moving_variance, moving_variance * decay + batch_var * (1 - decay))]):
                 return tf.identity(batch_mean), tf.identity(batch_var)
 
-        mean, variance = tf.cond(trainable, mean_and_var_update, lambda: (moving_mean, moving_variance))
-        return tf.nn.batch_normalization(input_data, mean, variance, beta, gamma, 1e-05)
+        if isinstance(trainable, bool):
+            # a python bool builds only one branch, e.g. the frozen inference graph of freeze_graph.py
+            mean, variance = mean_and_var_update() if trainable else (moving_mean, moving_variance)
+        else:
+            mean, variance = tf.cond(trainable, mean_and_var_update, lambda: (moving_mean, moving_variance))
+        return tf.nn.batch_normalization(input_data, tf.cast(mean, input_data.dtype), tf.cast(variance, input_data.dtype),
+                                         beta, gamma, 1e-05)
 
 def residual_block(input_data, input_channel, filter_num1, filter_num2, trainable, name):
 
@@ -36,20 +36,52 @@ __C.YOLO.DEMO_WEIGHT            = "./checkpoint/yolov3_coco_demo.ckpt"
 
 __C.YOLO.BACKBONE_MOBILE        = False
 __C.YOLO.GT_PER_GRID            = 3
+__C.YOLO.INPUT_UINT8            = False
+__C.YOLO.PRECISION              = "float32"
 
 # Train options
 __C.TRAIN                       = edict()
 
 __C.TRAIN.ANNOT_PATH            = "/home/ubuntu/hanhbd/safety/TF_yolov3/data/dataset/voc_train.txt"
+__C.TRAIN.PACKED_PATH           = ""
+__C.TRAIN.STREAM                = False
+__C.TRAIN.STREAM_BUFFER         = 10000
+__C.TRAIN.STREAM_BLOCK_BYTES    = 1 << 20
 __C.TRAIN.BATCH_SIZE            = 6
 __C.TRAIN.INPUT_SIZE            = [320, 352, 384, 416, 448, 480, 512, 544, 576, 608]
+__C.TRAIN.SIZE_SCHEDULE         = "random"
+__C.TRAIN.SCALE_BATCH_SIZE      = False
 __C.TRAIN.DATA_AUG              = True
+__C.TRAIN.FUSED_AUG             = False
+# views of every decoded image, the batch size is rounded down to a multiple of it
+__C.TRAIN.REPEAT_AUG            = 1
+__C.TRAIN.REDUCED_DECODE        = False
+__C.TRAIN.RECT                  = False
+__C.TRAIN.GRAPH_LABELS          = False
+__C.TRAIN.ASPECT_BUCKETS        = [0.5625, 0.75, 1.0, 1.3333, 1.7778]
 __C.TRAIN.LEARN_RATE_INIT       = 1e-4
 __C.TRAIN.LEARN_RATE_END        = 1e-6
 __C.TRAIN.WARMUP_EPOCHS         = 2
 __C.TRAIN.FISRT_STAGE_EPOCHS    = 20
 __C.TRAIN.SECOND_STAGE_EPOCHS   = 40
 __C.TRAIN.INITIAL_WEIGHT        = "./checkpoint/yolov3_coco_demo.ckpt"
+__C.TRAIN.RESUME                = ""
+__C.TRAIN.SAVE_STEPS            = 0
+__C.TRAIN.SEED                  = None
+# train.py sets both per process from --rank / --world_size or the RANK / WORLD_SIZE of the launcher
+__C.TRAIN.RANK                  = 0
+__C.TRAIN.WORLD_SIZE            = 1
+__C.TRAIN.NUM_WORKERS           = 0
+__C.TRAIN.PREFETCH_DEPTH        = 4
+__C.TRAIN.BUFFER_SLOTS          = 2
+# decoded images of the train set. with NUM_WORKERS = 0 a least recently used cache in the trainer process.
+# with NUM_WORKERS > 0 one shared memory arena of this size, allocated and zero filled up front and shared
+# by all the workers (not one per worker), which is filled once and never evicts: the images decoded after
+# it is full are never cached
+__C.TRAIN.IMAGE_CACHE_BYTES     = 0
+__C.TRAIN.PROFILE               = False
+__C.TRAIN.LOSS_SCALE            = 2. ** 15
+__C.TRAIN.LOSS_SCALE_PERIOD     = 2000
 
 
 
@@ -57,16 +89,28 @@ __C.TRAIN.INITIAL_WEIGHT        = "./checkpoint/yolov3_coco_demo.ckpt"
 __C.TEST                        = edict()
 
 __C.TEST.ANNOT_PATH             = "/home/ubuntu/hanhbd/safety/TF_yolov3/data/dataset/voc_test.txt"
+__C.TEST.PACKED_PATH            = ""
+__C.TEST.CACHE_PATH             = ""
 __C.TEST.BATCH_SIZE             = 2
 __C.TEST.INPUT_SIZE             = 544
 __C.TEST.DATA_AUG               = False
+__C.TEST.REDUCED_DECODE         = False
+__C.TEST.NUM_WORKERS            = 0
+# the same for the test set, a budget of its own on top of TRAIN.IMAGE_CACHE_BYTES
+__C.TEST.IMAGE_CACHE_BYTES      = 0
+__C.TEST.RECT                   = False
 __C.TEST.WRITE_IMAGE            = True
 __C.TEST.WRITE_IMAGE_PATH       = "./data/detection/"
 __C.TEST.WRITE_IMAGE_SHOW_LABEL = True
 __C.TEST.WEIGHT_FILE            = "./checkpoint/yolov3_test_loss=9.2099.ckpt-5"
+__C.TEST.FOLDED_BN              = False
+__C.TEST.TFLITE_FILE            = ""
 __C.TEST.SHOW_LABEL             = True
 __C.TEST.SCORE_THRESHOLD        = 0.3
 __C.TEST.IOU_THRESHOLD          = 0.45
+__C.TEST.GRAPH_NMS              = False
+__C.TEST.NMS_METHOD             = "nms"
+__C.TEST.MAX_DETECTIONS         = 100
 
 
 
@@ -13,93 +13,519 @@
 
 import os
 import cv2
+import time
+import argparse
+import itertools
 import random
+from collections import deque
 import numpy as np
 import tensorflow as tf
 import core.utils as utils
 from core.config import cfg
-
+from core.cache import ImageCache, SharedImageCache
+from core.profiler import StageProfiler
+from core.prefetch import BatchPrefetcher
+from core.shard import PackedShards
+from core.annotation import load_annotation_index, AnnotationStream, source_stamp
+from core.preprocessed import PreprocessedSet
+
+
+
+class BatchBuffer(object):
+    """the arrays of one batch plus the label cells written into them"""
+    def __init__(self, image, label, bboxes):
+        self.image   = image
+        self.label   = label
+        self.bboxes  = bboxes
+        self.touched = []
+
+    def clear(self):
+        """reset the buffer for the next batch, the image is overwritten entirely so it is left alone"""
+        for label, cells in zip(self.label, self.touched):
+            label[cells] = 0
+        for bboxes in self.bboxes:
+            bboxes.fill(0)
+        self.touched = []
+
+    def arrays(self):
+        return (self.image,) + tuple(self.label) + tuple(self.bboxes)
+
+
+class BatchBufferPool(object):
+    """
+    recycle the batch arrays of every input size instead of allocating them for every batch.
+    a batch handed out stays valid until `num_slots` more batches of the same size are acquired.
+    """
+    def __init__(self, allocate, num_slots=2):
+        self.allocate  = allocate
+        self.num_slots = num_slots
+        self.slots     = {}
+        self.cursor    = {}
+
+    def acquire(self, input_size):
+
+        if input_size not in self.slots:
+            self.slots[input_size] = [None] * self.num_slots
+            self.cursor[input_size] = 0
+        slot = self.cursor[input_size]
+        self.cursor[input_size] = (slot + 1) % self.num_slots
+
+        buffer = self.slots[input_size][slot]
+        if buffer is None:
+            buffer = self.slots[input_size][slot] = self.allocate(input_size)
+        else:
+            buffer.clear()
+        return buffer
 
 
 class Dataset(object):
-    """implement Dataset here"""
-    def __init__(self, dataset_type):
+    """
+    implement Dataset here.
+    with world_size > 1 every rank builds the batches of its own part of each epoch, the epochs are
+    shuffled with the shared TRAIN.SEED so the parts are disjoint and hold the same number of batches
+    """
+    def __init__(self, dataset_type, rank=None, world_size=None):
         self.annot_path  = cfg.TRAIN.ANNOT_PATH if dataset_type == 'train' else cfg.TEST.ANNOT_PATH
+        self.packed_path = cfg.TRAIN.PACKED_PATH if dataset_type == 'train' else cfg.TEST.PACKED_PATH
+        self.stream      = cfg.TRAIN.STREAM      if dataset_type == 'train' else False
         self.input_sizes = cfg.TRAIN.INPUT_SIZE if dataset_type == 'train' else cfg.TEST.INPUT_SIZE
         self.batch_size  = cfg.TRAIN.BATCH_SIZE if dataset_type == 'train' else cfg.TEST.BATCH_SIZE
         self.data_aug    = cfg.TRAIN.DATA_AUG   if dataset_type == 'train' else cfg.TEST.DATA_AUG
 
-        self.train_input_sizes = cfg.TRAIN.INPUT_SIZE
+        # the test set always runs at the fixed TEST.INPUT_SIZE
+        self.train_input_sizes = cfg.TRAIN.INPUT_SIZE if dataset_type == 'train' else [cfg.TEST.INPUT_SIZE]
         self.strides = np.array(cfg.YOLO.STRIDES)
         self.classes = utils.read_class_names(cfg.YOLO.CLASSES)
         self.num_classes = len(self.classes)
         self.anchors = np.array(utils.get_anchors(cfg.YOLO.ANCHORS))
         self.anchor_per_scale = cfg.YOLO.ANCHOR_PER_SCALE
         self.max_bbox_per_scale = 150
+        self.uint8_input = cfg.YOLO.INPUT_UINT8
+        self.fused_aug = cfg.TRAIN.FUSED_AUG
+        self.repeat_aug = max(int(cfg.TRAIN.REPEAT_AUG), 1) if dataset_type == 'train' else 1
+        if self.batch_size < self.repeat_aug:
+            raise ValueError("TRAIN.BATCH_SIZE %d holds less than the %d views of TRAIN.REPEAT_AUG"
+                             % (self.batch_size, self.repeat_aug))
+        # every sample gets all of its k views in one batch
+        self.batch_size = self.batch_size // self.repeat_aug * self.repeat_aug
+        self.graph_labels = cfg.TRAIN.GRAPH_LABELS
+        self.reduced_decode = cfg.TRAIN.REDUCED_DECODE if dataset_type == 'train' else cfg.TEST.REDUCED_DECODE
+        # one decode size for all input sizes, so cached images fit every batch
+        self.decode_size = (max(self.train_input_sizes), max(self.train_input_sizes))
+        self.rect = cfg.TRAIN.RECT if dataset_type == 'train' else cfg.TEST.RECT
+        self.size_schedule = cfg.TRAIN.SIZE_SCHEDULE if dataset_type == 'train' else 'random'
+        self.scale_batch_size = cfg.TRAIN.SCALE_BATCH_SIZE if dataset_type == 'train' else False
+        self.total_epochs = cfg.TRAIN.FISRT_STAGE_EPOCHS + cfg.TRAIN.SECOND_STAGE_EPOCHS
+        self.aspect_buckets = np.array(cfg.TRAIN.ASPECT_BUCKETS)
+
+        self.num_workers = cfg.TRAIN.NUM_WORKERS if dataset_type == 'train' else cfg.TEST.NUM_WORKERS
+        self.prefetch_depth = cfg.TRAIN.PREFETCH_DEPTH
+        self.buffer_pool = BatchBufferPool(self.allocate_batch, cfg.TRAIN.BUFFER_SLOTS) if cfg.TRAIN.BUFFER_SLOTS > 0 else None
+        self.dataset_type = dataset_type
+        self.profiler = StageProfiler(enabled=cfg.TRAIN.PROFILE)
+        self.rank = (cfg.TRAIN.RANK if dataset_type == 'train' else 0) if rank is None else rank
+        self.world_size = (cfg.TRAIN.WORLD_SIZE if dataset_type == 'train' else 1) if world_size is None else world_size
+        assert 0 <= self.rank < self.world_size
+        if self.world_size > 1 and cfg.TRAIN.SEED is None:
+            raise ValueError("TRAIN.SEED has to be set for sharded training, every rank shuffles with it")
+        self.rng = np.random.RandomState(cfg.TRAIN.SEED)
+        self.aug_rng = random.Random()
 
         self.annotations = self.load_annotations(dataset_type)
         self.num_samples = len(self.annotations)
-        self.num_batchs = int(np.ceil(self.num_samples / self.batch_size))
+        self.image_cache = None
+        cache_bytes = cfg.TRAIN.IMAGE_CACHE_BYTES if dataset_type == 'train' else cfg.TEST.IMAGE_CACHE_BYTES
+        if cache_bytes > 0 and self.num_workers > 0:
+            # one cache shared by the prefetch workers, each worker sees the images the others decoded
+            self.image_cache = SharedImageCache(cache_bytes, self.num_samples)
+        elif cache_bytes > 0:
+            self.image_cache = ImageCache(cache_bytes)
+        self.preprocessed = None
+        if dataset_type == 'test' and cfg.TEST.CACHE_PATH:
+            self.preprocessed = self.load_preprocessed(cfg.TEST.CACHE_PATH)
+            self.annotations = np.arange(self.num_samples)
+        if self.rect:
+            self.buckets = self.bucket_annotations()
+        self.epoch = 0
+        self.size_cursor = 0
         self.batch_count = 0
+        self.batch_submitted = 0
+        self.submitted_sizes = deque()
+        self.prefetcher = None
+        self.start_epoch()
+        # the workers are forked here, before the trainer builds its graph and session: forking a process
+        # which already runs the tensorflow and cuda threads can deadlock the children
+        if self.num_workers > 0:
+            self.prefetcher = BatchPrefetcher(self, self.num_workers, self.prefetch_depth)
+
+    def __getstate__(self):
+        # the prefetch workers only call load_batch, the epoch generator can not be pickled anyway
+        state = self.__dict__.copy()
+        state['batch_tasks'] = None
+        state['prefetcher'] = None
+        return state
 
 
     def load_annotations(self, dataset_type):
-        with open(self.annot_path, 'r') as f:
-            txt = f.readlines()
-            annotations = [line.strip() for line in txt if len(line.strip().split()[1:]) != 0]
-        np.random.shuffle(annotations)
+        """
+        annotations are (shard, index) records of the packed shards or the line numbers of
+        the compiled annotation index, lines without any box are skipped.
+        with TRAIN.STREAM they are an AnnotationStream read lazily on every epoch
+        """
+        self.packed = None
+        self.index = None
+        if self.stream:
+            assert not self.packed_path and not self.rect, "TRAIN.STREAM reads the annotation txt in file order"
+            return AnnotationStream(self.annot_path, cfg.TRAIN.STREAM_BLOCK_BYTES, cfg.TRAIN.STREAM_BUFFER)
+        if self.packed_path:
+            self.packed = PackedShards(self.packed_path)
+            return self.packed.shuffled_records(self.rng)
+
+        self.index = load_annotation_index(self.annot_path)
+        annotations = np.nonzero(self.index.num_bboxes() > 0)[0]
+        self.rng.shuffle(annotations)
         return annotations
 
+    def load_preprocessed(self, cache_dir):
+        """
+        letterbox the samples once at TEST.INPUT_SIZE into cache_dir, later epochs and runs read them from there.
+        the boxes are cached instead of the label grids, which are much larger and fast to encode again
+        """
+        assert not self.rect and not self.data_aug, "the preprocessed set is not augmented and has one input size"
+        input_size = self.train_input_sizes[0]
+        stamp = source_stamp(os.path.join(self.packed_path, '00000.npz') if self.packed_path else self.annot_path)
+        if not PreprocessedSet.is_valid(cache_dir, self.num_samples, input_size, stamp):
+            print('=> preprocess %d samples at %d into %s' % (self.num_samples, input_size, cache_dir))
+            samples = (self.read_annotation(annotation) for annotation in self.annotations)
+            PreprocessedSet.build(cache_dir, samples, self.num_samples, input_size, stamp)
+        return PreprocessedSet(cache_dir)
+
+    def shuffle_annotations(self):
+        if self.stream:
+            return
+        if self.packed is not None:
+            self.annotations = self.packed.shuffled_records(self.rng)
+        else:
+            self.rng.shuffle(self.annotations)
+
+    def image_size(self, annotation):
+        if self.packed is not None:
+            return tuple(self.packed.indexes[annotation[0]]['sizes'][annotation[1]])
+        if self.index.has_sizes:
+            return self.index.image_size(annotation)
+        return utils.read_image_size(self.index.path(annotation))
+
+    def bucket_annotations(self):
+        """group the annotations by the aspect bucket (height / width) closest to their image"""
+        sizes = np.array([self.image_size(annotation) for annotation in self.annotations], dtype=np.float64)
+        distance = np.abs(np.log(sizes[:, 0:1] / sizes[:, 1:2]) - np.log(self.aspect_buckets)[np.newaxis, :])
+        bucket_ind = np.argmin(distance, axis=-1)
+        return [self.annotations[bucket_ind == bucket] for bucket in range(len(self.aspect_buckets))]
+
+    def start_epoch(self):
+        # the plan only depends on these and the annotation order, a saved state replans the epoch from them
+        self.epoch_rng_state = self.rng.get_state()
+        self.epoch_size_cursor = self.size_cursor
+        if self.stream:
+            # the number of batches of a stream is only known at its end, len() is an estimate
+            self.batch_plan = None
+            self.batch_tasks = self.plan_stream_epoch()
+            self.num_batchs = int(np.ceil(1.0 * self.repeat_samples(self.num_samples) /
+                                          (self.repeat_samples(self.batch_size) * self.world_size)))
+        else:
+            self.batch_plan = self.plan_epoch()
+            self.batch_tasks = iter(self.batch_plan)
+            self.num_batchs = len(self.batch_plan)
+        self.batch_submitted = 0
+
+    def draw_input_size(self):
+        """
+        random:      a random TRAIN.INPUT_SIZE for every batch
+        round_robin: cycle through the sizes batch after batch
+        progressive: go from the smallest to the largest size over the training epochs
+        """
+        sizes = self.train_input_sizes
+        if self.size_schedule == 'round_robin':
+            self.size_cursor += 1
+            return sizes[(self.size_cursor - 1) % len(sizes)]
+        if self.size_schedule == 'progressive':
+            return sorted(sizes)[min(self.epoch * len(sizes) // max(self.total_epochs, 1), len(sizes) - 1)]
+        return sizes[self.rng.randint(len(sizes))]
+
+    def batch_size_for(self, input_size):
+        """
+        with TRAIN.SCALE_BATCH_SIZE the batch size grows as the input shrinks, so every batch holds about
+        as many pixels as TRAIN.BATCH_SIZE images of the largest input size. it is always a multiple of
+        TRAIN.REPEAT_AUG
+        """
+        if not self.scale_batch_size:
+            return self.batch_size
+        input_h, input_w = tuple(input_size) if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+        max_size = max(self.train_input_sizes)
+        batch_size = int(self.batch_size * max_size * max_size // (input_h * input_w))
+        return max(self.repeat_aug, batch_size // self.repeat_aug * self.repeat_aug)
+
+    def repeat_samples(self, num):
+        """
+        with TRAIN.REPEAT_AUG = k every decoded sample is augmented into k views of the same batch,
+        so a batch of `num` views only holds this many distinct samples
+        """
+        return -(-num // self.repeat_aug)
+
+    def samples_per_epoch(self):
+        """
+        the number of views an epoch trains on. with repeated augmentation an epoch keeps about as many
+        views as samples, and only decodes a new random 1/k of the samples, so the epochs of the
+        learning rate schedule still mean the same number of steps
+        """
+        if self.stream:
+            return -(-self.num_samples // self.world_size)
+        return sum(self.batch_size_for(input_size) for _, input_size, _ in self.batch_plan)
+
+    def draw_seed(self):
+        """augmentation seed of a batch, drawn from the rng shared by all ranks but different on every rank"""
+        return self.rng.randint(np.iinfo(np.int32).max) * self.world_size + self.rank
+
+    def shard_range(self, num):
+        """the contiguous part of [0, num) of this rank, wrapped around so every rank gets as many positions"""
+        if num == 0: return np.arange(0)
+        per_rank = -(-num // self.world_size)
+        return (self.rank * per_rank + np.arange(per_rank)) % num
+
+    def plan_epoch(self):
+        """
+        draw the samples, input size and augmentation seed of every batch of the epoch up front,
+        so the batches do not depend on which process builds them
+        """
+        if self.rect:
+            return self.plan_rect_epoch()
+
+        shard = self.annotations[self.shard_range(self.num_samples)]
+        shard = shard[:self.repeat_samples(len(shard))]
+        plan = []
+        start = 0
+        while start < len(shard):
+            input_size = self.draw_input_size()
+            batch_size = self.repeat_samples(self.batch_size_for(input_size))
+            indices = (start + np.arange(batch_size)) % len(shard)
+            annotations = shard[indices]
+            seed = self.draw_seed()
+            plan.append((annotations, input_size, seed))
+            start += batch_size
+        return plan
+
+    def plan_rect_epoch(self):
+        """
+        every batch is drawn from one aspect bucket and letterboxed to a (height, width) input whose longest
+        side is the drawn input size, so landscape frames are not padded into squares
+        """
+        batches = []
+        for bucket, annotations in enumerate(self.buckets):
+            order = self.rng.permutation(len(annotations))
+            order = order[self.shard_range(len(order))]
+            order = order[:self.repeat_samples(len(order))]
+            start = 0
+            while start < len(order):
+                input_size = self.draw_input_size()
+                input_size = utils.rect_input_size(self.aspect_buckets[bucket], input_size, self.strides[-1])
+                batch_size = self.repeat_samples(self.batch_size_for(input_size))
+                indices = order[(start + np.arange(batch_size)) % len(order)]
+                batches.append((annotations[indices], input_size))
+                start += batch_size
+
+        plan = []
+        for batch_index in self.rng.permutation(len(batches)):
+            annotations, input_size = batches[batch_index]
+            seed = self.draw_seed()
+            plan.append((annotations, input_size, seed))
+        return plan
+
+    def plan_stream_epoch(self):
+        """
+        same as plan_epoch, but the batches are drawn as the annotation stream is read.
+        every rank reads the whole stream and keeps its part of each group of world_size batches
+        """
+        samples = itertools.islice(self.annotations.iterate(self.rng), self.repeat_samples(self.num_samples))
+        while True:
+            input_size = self.draw_input_size()
+            batch_size = self.repeat_samples(self.batch_size_for(input_size))
+            annotations = list(itertools.islice(samples, batch_size * self.world_size))
+            if len(annotations) == 0: return
+            annotations = [annotations[index % len(annotations)]
+                           for index in range(self.rank * batch_size, (self.rank + 1) * batch_size)]
+            seed = self.draw_seed()
+            yield annotations, input_size, seed
+
+    def set_input_size(self, input_size):
+        """input_size is the side of a square batch or the (height, width) of a rectangular one"""
+        self.train_input_size = input_size
+        self.train_input_hw = tuple(input_size) if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+        self.train_output_sizes = np.array(self.train_input_hw)[np.newaxis, :] // self.strides[:, np.newaxis]
+
     def __iter__(self):
         return self
 
     def __next__(self):
 
         with tf.device('/cpu:0'):
-            self.train_input_size = random.choice(self.train_input_sizes)
-            self.train_output_sizes = self.train_input_size // self.strides
-
-            batch_image = np.zeros((self.batch_size, self.train_input_size, self.train_input_size, 3))
-
-            batch_label_sbbox = np.zeros((self.batch_size, self.train_output_sizes[0], self.train_output_sizes[0],
-                                          self.anchor_per_scale, 5 + self.num_classes))
-            batch_label_mbbox = np.zeros((self.batch_size, self.train_output_sizes[1], self.train_output_sizes[1],
-                                          self.anchor_per_scale, 5 + self.num_classes))
-            batch_label_lbbox = np.zeros((self.batch_size, self.train_output_sizes[2], self.train_output_sizes[2],
-                                          self.anchor_per_scale, 5 + self.num_classes))
-
-            batch_sbboxes = np.zeros((self.batch_size, self.max_bbox_per_scale, 4))
-            batch_mbboxes = np.zeros((self.batch_size, self.max_bbox_per_scale, 4))
-            batch_lbboxes = np.zeros((self.batch_size, self.max_bbox_per_scale, 4))
-
-            num = 0
-            if self.batch_count < self.num_batchs:
-                while num < self.batch_size:
-                    index = self.batch_count * self.batch_size + num
-                    if index >= self.num_samples: index -= self.num_samples
-                    annotation = self.annotations[index]
-                    image, bboxes = self.parse_annotation(annotation)
-                    label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = self.preprocess_true_boxes(bboxes)
-
-                    batch_image[num, :, :, :] = image
-                    batch_label_sbbox[num, :, :, :, :] = label_sbbox
-                    batch_label_mbbox[num, :, :, :, :] = label_mbbox
-                    batch_label_lbbox[num, :, :, :, :] = label_lbbox
-                    batch_sbboxes[num, :, :] = sbboxes
-                    batch_mbboxes[num, :, :] = mbboxes
-                    batch_lbboxes[num, :, :] = lbboxes
-                    num += 1
+            if self.num_workers > 0:
+                batch = self.prefetch_batch()
+            else:
+                batch_task = next(self.batch_tasks, None)
+                batch = None if batch_task is None else self.load_batch(*batch_task)
+
+            if batch is not None:
                 self.batch_count += 1
-                return batch_image, batch_label_sbbox, batch_label_mbbox, batch_label_lbbox, \
-                       batch_sbboxes, batch_mbboxes, batch_lbboxes
+                self.profiler.samples += len(batch[0])
+                return batch
             else:
+                if self.profiler.enabled:
+                    self.report_epoch()
                 self.batch_count = 0
-                np.random.shuffle(self.annotations)
+                self.epoch += 1
+                self.shuffle_annotations()
+                self.start_epoch()
                 raise StopIteration
 
+    def state_dict(self):
+        """
+        the position of the iterator, with it load_state_dict continues from the next batch.
+        the shuffled annotations are part of it, the annotation stream is replayed from its rng state instead
+        """
+        _, rng_keys, rng_pos, rng_has_gauss, rng_gauss = self.epoch_rng_state
+        state = {'epoch':         self.epoch,
+                 'batch_count':   self.batch_count,
+                 'size_cursor':   self.epoch_size_cursor,
+                 'rng_keys':      rng_keys,
+                 'rng_pos':       rng_pos,
+                 'rng_has_gauss': rng_has_gauss,
+                 'rng_gauss':     rng_gauss}
+        if not self.stream:
+            state['annotations'] = self.annotations
+        if self.rect:
+            state['buckets'] = np.concatenate(self.buckets, axis=0)
+            state['bucket_sizes'] = np.array([len(bucket) for bucket in self.buckets])
+        if hasattr(self, 'train_input_hw'):
+            state['input_size'] = np.array(self.train_input_size)
+        return state
+
+    def load_state_dict(self, state):
+        """replan the saved epoch and skip the batches already consumed, without reading their images"""
+        if self.prefetcher is not None:
+            self.prefetcher.reset()
+        self.epoch = int(state['epoch'])
+        self.size_cursor = int(state['size_cursor'])
+        self.rng.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+                            int(state['rng_has_gauss']), float(state['rng_gauss'])))
+        if 'annotations' in state:
+            self.annotations = np.array(state['annotations'])
+        if 'buckets' in state:
+            self.buckets = np.split(np.array(state['buckets']), np.cumsum(state['bucket_sizes'])[:-1])
+        if 'input_size' in state:
+            input_size = state['input_size']
+            self.set_input_size(tuple(input_size.tolist()) if input_size.ndim else int(input_size))
+
+        self.start_epoch()
+        self.batch_count = int(state['batch_count'])
+        for _ in range(self.batch_count):
+            next(self.batch_tasks)
+        self.batch_submitted = self.batch_count
+        self.submitted_sizes.clear()
+
+    def save_state(self, state_path):
+        np.savez(state_path, **self.state_dict())
+
+    def load_state(self, state_path):
+        with np.load(state_path) as state:
+            self.load_state_dict({key: state[key] for key in state.files})
+
+    def prefetch_batch(self):
+
+        if self.prefetcher is None:
+            self.prefetcher = BatchPrefetcher(self, self.num_workers, self.prefetch_depth)
+
+        while not self.prefetcher.full():
+            batch_task = next(self.batch_tasks, None)
+            if batch_task is None: break
+            self.prefetcher.put(self.batch_submitted, batch_task)
+            self.submitted_sizes.append(batch_task[1])
+            self.batch_submitted += 1
+
+        if self.batch_count == self.batch_submitted:
+            return None
+        self.set_input_size(self.submitted_sizes.popleft())
+        batch, stages = self.prefetcher.get(self.batch_count)
+        self.profiler.merge(stages)
+        return batch
+
+    def report_epoch(self):
+
+        print(self.profiler.report('%s epoch %d' % (self.dataset_type, self.epoch + 1)))
+        if self.image_cache is not None:
+            print('   ' + self.image_cache.report())
+        self.profiler.reset()
+
+    def load_batch(self, annotations, input_size, seed):
+
+        with self.profiler.stage('batch'):
+            return self.build_batch(annotations, input_size, seed)
+
+    def build_batch(self, annotations, input_size, seed):
+
+        self.aug_rng.seed(seed)
+        self.set_input_size(input_size)
+
+        if self.buffer_pool is not None:
+            buffer = self.buffer_pool.acquire(self.train_input_size)
+        else:
+            buffer = self.allocate_batch(self.train_input_size)
+
+        batch_bboxes = []
+        for num in range(self.batch_size_for(input_size)):
+            # the k views of a sample are next to each other and share one decode
+            annotation = annotations[num // self.repeat_aug]
+            if num % self.repeat_aug == 0:
+                decoded = self.read_annotation(annotation) if self.repeat_aug > 1 else None
+            _, bboxes = self.parse_annotation(annotation, out=buffer.image[num], decoded=decoded)
+            batch_bboxes.append(bboxes)
+        with self.profiler.stage('label'):
+            if self.graph_labels:
+                return buffer.image, self.pad_true_boxes(batch_bboxes)
+            else:
+                self.preprocess_true_boxes_batch(batch_bboxes, buffer)
+
+        return buffer.arrays()
+
+    def allocate_batch(self, input_size, batch_size=None, with_image=True, with_label=None):
+        """
+        the arrays of a batch. with TRAIN.GRAPH_LABELS (with_label=False) the labels are built by
+        YOLOV3.build_labels instead, and the batch only holds the image, see pad_true_boxes
+        """
+        batch_size = self.batch_size_for(input_size) if batch_size is None else batch_size
+        input_h, input_w = tuple(input_size) if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+        output_sizes = np.array([input_h, input_w])[np.newaxis, :] // self.strides[:, np.newaxis]
+
+        image = None
+        if with_image:
+            image = np.zeros((batch_size, input_h, input_w, 3), dtype=np.uint8 if self.uint8_input else np.float32)
+        with_label = not self.graph_labels if with_label is None else with_label
+        if not with_label:
+            return BatchBuffer(image, [], [])
+
+        label = [np.zeros((batch_size, output_sizes[i][0], output_sizes[i][1], self.anchor_per_scale, 5 + self.num_classes),
+                          dtype=np.float32) for i in range(3)]
+        bboxes = [np.zeros((batch_size, self.max_bbox_per_scale, 4), dtype=np.float32) for _ in range(3)]
+        return BatchBuffer(image, label, bboxes)
+
+    def close(self):
+
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+
     def random_horizontal_flip(self, image, bboxes):
 
-        if random.random() < 0.5:
+        if self.aug_rng.random() < 0.5:
             _, w, _ = image.shape
             image = image[:, ::-1, :]
             bboxes[:, [0,2]] = w - bboxes[:, [2,0]]
@@ -108,7 +534,7 @@ class Dataset(object):
 
     def random_crop(self, image, bboxes):
 
-        if random.random() < 0.5:
+        if self.aug_rng.random() < 0.5:
             h, w, _ = image.shape
             max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
 
@@ -117,10 +543,10 @@ class Dataset(object):
             max_r_trans = w - max_bbox[2]
             max_d_trans = h - max_bbox[3]
 
-            crop_xmin = max(0, int(max_bbox[0] - random.uniform(0, max_l_trans)))
-            crop_ymin = max(0, int(max_bbox[1] - random.uniform(0, max_u_trans)))
-            crop_xmax = max(w, int(max_bbox[2] + random.uniform(0, max_r_trans)))
-            crop_ymax = max(h, int(max_bbox[3] + random.uniform(0, max_d_trans)))
+            crop_xmin = max(0, int(max_bbox[0] - self.aug_rng.uniform(0, max_l_trans)))
+            crop_ymin = max(0, int(max_bbox[1] - self.aug_rng.uniform(0, max_u_trans)))
+            crop_xmax = max(w, int(max_bbox[2] + self.aug_rng.uniform(0, max_r_trans)))
+            crop_ymax = max(h, int(max_bbox[3] + self.aug_rng.uniform(0, max_d_trans)))
 
             image = image[crop_ymin : crop_ymax, crop_xmin : crop_xmax]
 
@@ -131,7 +557,7 @@ class Dataset(object):
 
     def random_translate(self, image, bboxes):
 
-        if random.random() < 0.5:
+        if self.aug_rng.random() < 0.5:
             h, w, _ = image.shape
             max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
 
@@ -140,8 +566,8 @@ class Dataset(object):
             max_r_trans = w - max_bbox[2]
             max_d_trans = h - max_bbox[3]
 
-            tx = random.uniform(-(max_l_trans - 1), (max_r_trans - 1))
-            ty = random.uniform(-(max_u_trans - 1), (max_d_trans - 1))
+            tx = self.aug_rng.uniform(-(max_l_trans - 1), (max_r_trans - 1))
+            ty = self.aug_rng.uniform(-(max_u_trans - 1), (max_d_trans - 1))
 
             M = np.array([[1, 0, tx], [0, 1, ty]])
             image = cv2.warpAffine(image, M, (w, h))
@@ -151,23 +577,160 @@ class Dataset(object):
 
         return image, bboxes
 
-    def parse_annotation(self, annotation):
-
-        line = annotation.split()
-        image_path = line[0]
-        if not os.path.exists(image_path):
-            raise KeyError("%s does not exist ... " %image_path)
-        image = np.array(cv2.imread(image_path))
-        bboxes = np.array([list(map(lambda x: int(float(x)), box.split(','))) for box in line[1:]])
+    def read_annotation(self, annotation):
+        """
+        return the decoded BGR image and the (N, 5) int boxes of an annotation.
+        the image may come from the image cache and is read only then.
+        with REDUCED_DECODE jpegs are decoded at 1/2, 1/4 or 1/8 scale when that still covers the
+        largest input size, the boxes are scaled to match
+        """
+        if self.stream:
+            image_path, bboxes = annotation
+            image, scale = self.cached_image(image_path, lambda: self.imread(image_path))
+            return image, utils.scale_bboxes(bboxes, scale)
+
+        if self.packed is not None:
+            shard, index = int(annotation[0]), int(annotation[1])
+            image, scale = self.cached_image((shard, index), lambda: self.packed_decode(shard, index))
+            return image, utils.scale_bboxes(self.packed.bboxes(shard, index), scale)
+
+        image_path = self.index.path(annotation)
+        image, scale = self.cached_image(int(annotation), lambda: self.imread(image_path))
+        return image, utils.scale_bboxes(self.index.bboxes(annotation), scale)
+
+    def imread(self, image_path):
+        """
+        return the image and the (y, x) scale it was decoded at. nothing is checked up front,
+        run core.validate on the annotation txt to find the missing and broken images before training
+        """
+        with self.profiler.stage('read'):
+            try:
+                encoded = np.fromfile(image_path, dtype=np.uint8)
+            except IOError:
+                raise KeyError("%s does not exist ... " % image_path)
+        with self.profiler.stage('decode'):
+            try:
+                if self.reduced_decode:
+                    return utils.imdecode_reduced(encoded, self.decode_size)
+                image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+            except (KeyError, cv2.error):
+                image = None
+        if image is None:
+            raise KeyError("%s can not be decoded ... " % image_path)
+        return image, (1.0, 1.0)
+
+    def packed_decode(self, shard, index):
+        """the encoded bytes are memory mapped, so reading them from disk happens inside the decode"""
+        with self.profiler.stage('decode'):
+            if self.reduced_decode:
+                return self.packed.decode_reduced(shard, index, self.decode_size)
+            return self.packed.decode(shard, index), (1.0, 1.0)
+
+    def cached_image(self, key, decode):
+        """decode() returns the image and its decode scale, both are cached"""
+        if self.image_cache is None:
+            return decode()
+        entry = self.image_cache.get(key)
+        if entry is None:
+            entry = self.image_cache.put(key, *decode())
+        return entry
+
+    def parse_annotation(self, annotation, out=None, decoded=None):
+
+        if self.preprocessed is not None:
+            with self.profiler.stage('read'):
+                return self.preprocessed.read(annotation, out, self.uint8_input)
+
+        image, bboxes = self.read_annotation(annotation) if decoded is None else decoded
+        if self.fused_aug:
+            with self.profiler.stage('fused_aug'):
+                return self.fused_augment(image, bboxes, out=out)
 
         if self.data_aug:
-            image, bboxes = self.random_horizontal_flip(np.copy(image), np.copy(bboxes))
-            image, bboxes = self.random_crop(np.copy(image), np.copy(bboxes))
-            image, bboxes = self.random_translate(np.copy(image), np.copy(bboxes))
-
-        image, bboxes = utils.image_preporcess(np.copy(image), [self.train_input_size, self.train_input_size], np.copy(bboxes))
+            with self.profiler.stage('flip'):
+                image, bboxes = self.random_horizontal_flip(np.copy(image), np.copy(bboxes))
+            with self.profiler.stage('crop'):
+                image, bboxes = self.random_crop(np.copy(image), np.copy(bboxes))
+            with self.profiler.stage('translate'):
+                image, bboxes = self.random_translate(np.copy(image), np.copy(bboxes))
+
+        with self.profiler.stage('resize'):
+            image, bboxes = utils.image_preporcess(np.copy(image), list(self.train_input_hw), np.copy(bboxes),
+                                                   uint8=self.uint8_input, out=out)
         return image, bboxes
 
+    def warp_bboxes(self, M, bboxes):
+        """apply an axis aligned affine matrix to the corners of (N, 4+) boxes"""
+        bboxes = np.array(bboxes, dtype=np.float64)
+        x = bboxes[:, [0, 2]] * M[0, 0] + M[0, 2]
+        y = bboxes[:, [1, 3]] * M[1, 1] + M[1, 2]
+        bboxes[:, 0], bboxes[:, 2] = np.min(x, axis=-1), np.max(x, axis=-1)
+        bboxes[:, 1], bboxes[:, 3] = np.min(y, axis=-1), np.max(y, axis=-1)
+        return bboxes
+
+    def fused_augment(self, image, bboxes, out=None):
+        """
+        draw the same random flip, crop and translate as the step by step augmentation, compose them with the
+        letterbox resize into one affine matrix and warp the image once, straight into `out` when given.
+        """
+        h, w, _ = image.shape
+        M = np.eye(3)
+        border = cv2.BORDER_REPLICATE
+        flipped, crop_xmin, crop_ymin = False, 0, 0
+
+        if self.data_aug:
+            if self.aug_rng.random() < 0.5:
+                M = np.dot(np.array([[-1., 0., w], [0., 1., 0.], [0., 0., 1.]]), M)
+                flipped = True
+
+            if self.aug_rng.random() < 0.5:
+                max_bbox = self.warp_bboxes(M, bboxes)
+                max_bbox = np.concatenate([np.min(max_bbox[:, 0:2], axis=0), np.max(max_bbox[:, 2:4], axis=0)], axis=-1)
+                crop_xmin = max(0, int(max_bbox[0] - self.aug_rng.uniform(0, max_bbox[0])))
+                crop_ymin = max(0, int(max_bbox[1] - self.aug_rng.uniform(0, max_bbox[1])))
+                # random_crop never cuts the right and bottom sides, the draws only keep the same random stream
+                self.aug_rng.uniform(0, w - max_bbox[2])
+                self.aug_rng.uniform(0, h - max_bbox[3])
+
+                M = np.dot(np.array([[1., 0., -crop_xmin], [0., 1., -crop_ymin], [0., 0., 1.]]), M)
+                w, h = w - crop_xmin, h - crop_ymin
+
+            if self.aug_rng.random() < 0.5:
+                max_bbox = self.warp_bboxes(M, bboxes)
+                max_bbox = np.concatenate([np.min(max_bbox[:, 0:2], axis=0), np.max(max_bbox[:, 2:4], axis=0)], axis=-1)
+                tx = self.aug_rng.uniform(-(max_bbox[0] - 1), (w - max_bbox[2] - 1))
+                ty = self.aug_rng.uniform(-(max_bbox[1] - 1), (h - max_bbox[3] - 1))
+
+                M = np.dot(np.array([[1., 0., tx], [0., 1., ty], [0., 0., 1.]]), M)
+                border = cv2.BORDER_CONSTANT
+
+        input_h, input_w = self.train_input_hw
+        scale = min(input_w / w, input_h / h)
+        nw, nh = int(scale * w), int(scale * h)
+        dw, dh = (input_w - nw) // 2, (input_h - nh) // 2
+        M = np.dot(np.array([[1. * nw / w, 0., dw], [0., 1. * nh / h, dh], [0., 0., 1.]]), M)
+
+        # warp from the cropped view only, so what the crop removed is border as after random_crop, and not
+        # image content shifted back in by the translate. M maps pixel edges, opencv maps pixel centres
+        view_xmin = 0 if flipped else crop_xmin
+        view = image[crop_ymin:, view_xmin:view_xmin + w]
+        to_view = np.array([[1., 0., view_xmin], [0., 1., crop_ymin], [0., 0., 1.]])
+        to_centre = np.array([[1., 0., 0.5], [0., 1., 0.5], [0., 0., 1.]])
+        M_pixel = np.dot(np.dot(np.linalg.inv(to_centre), np.dot(M, to_view)), to_centre)
+
+        target = out if out is not None and out.dtype == np.uint8 else None
+        image_paded = cv2.warpAffine(view, M_pixel[:2], (input_w, input_h), dst=target, flags=cv2.INTER_LINEAR,
+                                     borderMode=border, borderValue=0)
+        image_paded[:dh], image_paded[dh+nh:] = 128, 128
+        image_paded[:, :dw], image_paded[:, dw+nw:] = 128, 128
+        cv2.cvtColor(image_paded, cv2.COLOR_BGR2RGB, dst=image_paded)
+
+        if not self.uint8_input:
+            image_paded = np.divide(image_paded, 255., out=out)
+
+        bboxes = np.concatenate([self.warp_bboxes(M, bboxes)[:, :4].astype(np.int64), bboxes[:, 4:]], axis=-1)
+        return image_paded, bboxes
+
     def bbox_iou(self, boxes1, boxes2):
 
         boxes1 = np.array(boxes1)
@@ -190,72 +753,130 @@ class Dataset(object):
 
         return inter_area / union_area
 
+    def pad_true_boxes(self, batch_bboxes):
+        """
+        the (N, 5) boxes of every image padded to the (B, largest N, 5) input of YOLOV3.build_labels, padding rows
+        have class -1. every box is kept, as by preprocess_true_boxes_batch, only the box lists of the three
+        scales are cut to max_bbox_per_scale
+        """
+        batch_bboxes = [np.reshape(bboxes, (-1, 5)) for bboxes in batch_bboxes]
+        boxes = np.zeros((len(batch_bboxes), max([1] + [len(bboxes) for bboxes in batch_bboxes]), 5), dtype=np.float32)
+        boxes[..., 4] = -1
+        for num, bboxes in enumerate(batch_bboxes):
+            boxes[num, :len(bboxes)] = bboxes
+        return boxes
+
     def preprocess_true_boxes(self, bboxes):
 
-        label = [np.zeros((self.train_output_sizes[i], self.train_output_sizes[i], self.anchor_per_scale,
-                           5 + self.num_classes)) for i in range(3)]
-        bboxes_xywh = [np.zeros((self.max_bbox_per_scale, 4)) for _ in range(3)]
-        bbox_count = np.zeros((3,))
-
-        for bbox in bboxes:
-            bbox_coor = bbox[:4]
-            bbox_class_ind = bbox[4]
-
-            onehot = np.zeros(self.num_classes, dtype=np.float)
-            onehot[bbox_class_ind] = 1.0
-            uniform_distribution = np.full(self.num_classes, 1.0 / self.num_classes)
-            deta = 0.01
-            smooth_onehot = onehot * (1 - deta) + deta * uniform_distribution
-
-            bbox_xywh = np.concatenate([(bbox_coor[2:] + bbox_coor[:2]) * 0.5, bbox_coor[2:] - bbox_coor[:2]], axis=-1)
-            bbox_xywh_scaled = 1.0 * bbox_xywh[np.newaxis, :] / self.strides[:, np.newaxis]
-
-            iou = []
-            exist_positive = False
-            for i in range(3):
-                anchors_xywh = np.zeros((self.anchor_per_scale, 4))
-                anchors_xywh[:, 0:2] = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32) + 0.5
-                anchors_xywh[:, 2:4] = self.anchors[i]
-
-                iou_scale = self.bbox_iou(bbox_xywh_scaled[i][np.newaxis, :], anchors_xywh)
-                iou.append(iou_scale)
-                iou_mask = iou_scale > 0.3
-
-                if np.any(iou_mask):
-                    xind, yind = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32)
-
-                    label[i][yind, xind, iou_mask, :] = 0
-                    label[i][yind, xind, iou_mask, 0:4] = bbox_xywh
-                    label[i][yind, xind, iou_mask, 4:5] = 1.0
-                    label[i][yind, xind, iou_mask, 5:] = smooth_onehot
-
-                    bbox_ind = int(bbox_count[i] % self.max_bbox_per_scale)
-                    bboxes_xywh[i][bbox_ind, :4] = bbox_xywh
-                    bbox_count[i] += 1
-
-                    exist_positive = True
-
-            if not exist_positive:
-                best_anchor_ind = np.argmax(np.array(iou).reshape(-1), axis=-1)
-                best_detect = int(best_anchor_ind / self.anchor_per_scale)
-                best_anchor = int(best_anchor_ind % self.anchor_per_scale)
-                xind, yind = np.floor(bbox_xywh_scaled[best_detect, 0:2]).astype(np.int32)
-
-                label[best_detect][yind, xind, best_anchor, :] = 0
-                label[best_detect][yind, xind, best_anchor, 0:4] = bbox_xywh
-                label[best_detect][yind, xind, best_anchor, 4:5] = 1.0
-                label[best_detect][yind, xind, best_anchor, 5:] = smooth_onehot
-
-                bbox_ind = int(bbox_count[best_detect] % self.max_bbox_per_scale)
-                bboxes_xywh[best_detect][bbox_ind, :4] = bbox_xywh
-                bbox_count[best_detect] += 1
-        label_sbbox, label_mbbox, label_lbbox = label
-        sbboxes, mbboxes, lbboxes = bboxes_xywh
-        return label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes
+        label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = self.preprocess_true_boxes_batch([bboxes])
+        return label_sbbox[0], label_mbbox[0], label_lbbox[0], sbboxes[0], mbboxes[0], lbboxes[0]
+
+    def preprocess_true_boxes_batch(self, batch_bboxes, buffer=None):
+        """
+        encode the ground truth boxes of a whole batch in one numpy pass, into a cleared `buffer` if given.
+        the labels are the same as assigning the boxes one by one: a box responds on every anchor with
+        iou > 0.3 (or on its best anchor if there is none), and when several boxes hit the same anchor
+        or overflow the `max_bbox_per_scale` slots the last box wins.
+        """
+        if buffer is None:
+            buffer = self.allocate_batch(self.train_input_size, len(batch_bboxes), with_image=False, with_label=True)
+        label, bboxes_xywh = buffer.label, buffer.bboxes
+
+        batch_ind = np.concatenate([np.full(len(bboxes), num, dtype=np.int64) for num, bboxes in enumerate(batch_bboxes)])
+        if len(batch_ind) > 0:
+            bboxes = np.concatenate([np.reshape(bboxes, (-1, 5)) for bboxes in batch_bboxes], axis=0)
+            buffer.touched = self.assign_true_boxes(bboxes, batch_ind, label, bboxes_xywh)
+
+        return label[0], label[1], label[2], bboxes_xywh[0], bboxes_xywh[1], bboxes_xywh[2]
+
+    def assign_true_boxes(self, bboxes, batch_ind, label, bboxes_xywh):
+        """
+        scatter `bboxes` (N, 5) into the per scale `label` (B, S, S, 3, 5 + C) and `bboxes_xywh` (B, 150, 4)
+        arrays, `batch_ind` (N,) gives the batch slot of every box and must be sorted.
+        return the touched label cells of every scale as (batch, y, x, anchor) index arrays.
+        """
+        num_bboxes = len(bboxes)
+        bbox_coor = bboxes[:, :4]
+        bbox_class_ind = bboxes[:, 4]
+
+        onehot = np.zeros((num_bboxes, self.num_classes), dtype=np.float64)
+        onehot[np.arange(num_bboxes), bbox_class_ind] = 1.0
+        uniform_distribution = np.full(self.num_classes, 1.0 / self.num_classes)
+        deta = 0.01
+        smooth_onehot = onehot * (1 - deta) + deta * uniform_distribution
+
+        bbox_xywh = np.concatenate([(bbox_coor[:, 2:] + bbox_coor[:, :2]) * 0.5, bbox_coor[:, 2:] - bbox_coor[:, :2]], axis=-1)
+        bbox_xywh_scaled = 1.0 * bbox_xywh[:, np.newaxis, :] / self.strides[np.newaxis, :, np.newaxis]
+        grid_xy = np.floor(bbox_xywh_scaled[..., 0:2]).astype(np.int32)
+
+        anchors_xywh = np.zeros((num_bboxes, 3, self.anchor_per_scale, 4))
+        anchors_xywh[..., 0:2] = grid_xy[:, :, np.newaxis, :] + 0.5
+        anchors_xywh[..., 2:4] = self.anchors
+
+        iou = self.bbox_iou(bbox_xywh_scaled[:, :, np.newaxis, :], anchors_xywh)
+        respond = iou > 0.3
+
+        no_positive = np.nonzero(~np.any(respond, axis=(1, 2)))[0]
+        best_anchor_ind = np.argmax(iou[no_positive].reshape(len(no_positive), 3 * self.anchor_per_scale), axis=-1)
+        respond[no_positive, best_anchor_ind // self.anchor_per_scale, best_anchor_ind % self.anchor_per_scale] = True
+
+        touched = []
+        for i in range(3):
+            output_h, output_w = label[i].shape[1:3]
+
+            box_ind, anchor_ind = np.nonzero(respond[:, i, :])
+            xind, yind = grid_xy[box_ind, i, 0], grid_xy[box_ind, i, 1]
+            cell = ((batch_ind[box_ind] * output_h + yind % output_h) * output_w + xind % output_w) \
+                   * self.anchor_per_scale + anchor_ind
+            _, last = np.unique(cell[::-1], return_index=True)
+            keep = len(cell) - 1 - last
+            box_ind, anchor_ind, xind, yind = box_ind[keep], anchor_ind[keep], xind[keep], yind[keep]
+            cell_ind = (batch_ind[box_ind], yind, xind, anchor_ind)
+
+            label[i][cell_ind + (slice(0, 4),)] = bbox_xywh[box_ind]
+            label[i][cell_ind + (4,)] = 1.0
+            label[i][cell_ind + (slice(5, None),)] = smooth_onehot[box_ind]
+            touched.append(cell_ind)
+
+            box_ind = np.nonzero(np.any(respond[:, i, :], axis=-1))[0]
+            box_batch_ind = batch_ind[box_ind]
+            group_start = np.searchsorted(box_batch_ind, box_batch_ind, side='left')
+            group_end = np.searchsorted(box_batch_ind, box_batch_ind, side='right')
+            rank = np.arange(len(box_ind)) - group_start
+            keep = rank >= group_end - group_start - self.max_bbox_per_scale
+            bboxes_xywh[i][box_batch_ind[keep], rank[keep] % self.max_bbox_per_scale] = bbox_xywh[box_ind[keep]]
+
+        return touched
 
     def __len__(self):
         return self.num_batchs
 
 
-
-
+def benchmark(dataset_type='train', num_batches=0, num_workers=None):
+    """run the loader without a model, the stage times and samples/s are printed when it stops"""
+    cfg.TRAIN.PROFILE = True
+    if num_workers is not None:
+        cfg.TRAIN.NUM_WORKERS = cfg.TEST.NUM_WORKERS = num_workers
+
+    start = time.time()
+    dataset = Dataset(dataset_type)
+    print('=> %s set of %d samples ready in %.1fs, %d batches per epoch' % (
+          dataset_type, dataset.num_samples, time.time() - start, len(dataset)))
+    dataset.profiler.reset()
+    for num, _ in enumerate(dataset, 1):
+        if num == num_batches:
+            dataset.report_epoch()
+            break
+    dataset.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action='store_true', help="measure the loader throughput with no model attached")
+    parser.add_argument("--dataset_type", default="train", choices=['train', 'test'])
+    parser.add_argument("--num_batches", type=int, default=0, help="stop after this many batches, 0 runs one epoch")
+    parser.add_argument("--num_workers", type=int, default=None, help="default: TRAIN.NUM_WORKERS / TEST.NUM_WORKERS")
+    flags = parser.parse_args()
+
+    if flags.benchmark:
+        benchmark(flags.dataset_type, flags.num_batches, flags.num_workers)
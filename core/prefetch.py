@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : prefetch.py
+#   Author      : YunYang1994
+#   Created date: 2019-03-20 10:12:41
+#   Description : multi-process batch producer for core.dataset
+#
+#================================================================
+
+import pickle
+import traceback
+import multiprocessing as mp
+
+
+def _worker_loop(dataset, task_queue, result_queue):
+
+    while True:
+        task = task_queue.get()
+        if task is None: break
+        batch_index, batch_task = task
+        try:
+            # pickle here rather than in the queue feeder thread, the batch arrays are recycled by the next task
+            batch = pickle.dumps(dataset.load_batch(*batch_task), protocol=pickle.HIGHEST_PROTOCOL)
+            result_queue.put((batch_index, batch, dataset.profiler.drain(), None))
+        except Exception:
+            result_queue.put((batch_index, None, None, traceback.format_exc()))
+
+
+class BatchPrefetcher(object):
+    """
+    Build batches of a Dataset in `num_workers` processes.
+
+    Every task carries everything a batch depends on (samples, input size and
+    augmentation seed), so the workers are stateless and the batches are the
+    same as the ones Dataset.load_batch builds in the trainer process.
+    At most `depth` batches are in flight or waiting to be consumed, which
+    bounds the memory held by the queues and the workers. The workers are
+    forked when the prefetcher is created, so create it before any
+    tensorflow session exists (Dataset does in its __init__).
+    """
+    def __init__(self, dataset, num_workers, depth):
+
+        self.depth        = max(depth, 1)
+        self.task_queue   = mp.Queue()
+        self.result_queue = mp.Queue(maxsize=self.depth)
+        self.ready        = {}
+        self.in_flight    = 0
+
+        self.workers = [mp.Process(target=_worker_loop, args=(dataset, self.task_queue, self.result_queue))
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def full(self):
+        return self.in_flight >= self.depth
+
+    def put(self, batch_index, batch_task):
+
+        assert not self.full(), "at most %d batches can be in flight" % self.depth
+        self.task_queue.put((batch_index, batch_task))
+        self.in_flight += 1
+
+    def get(self, batch_index):
+        """return the batch and the loader stage times the worker recorded for it"""
+        while batch_index not in self.ready:
+            index, batch, stages, error = self.result_queue.get()
+            if error is not None:
+                self.close()
+                raise RuntimeError("prefetch worker failed on batch %d:\n%s" % (index, error))
+            self.ready[index] = batch, stages
+        self.in_flight -= 1
+        batch, stages = self.ready.pop(batch_index)
+        return pickle.loads(batch), stages
+
+    def reset(self):
+        """drop the batches in flight or waiting, the workers keep running"""
+        while self.in_flight > len(self.ready):
+            index, batch, stages, error = self.result_queue.get()
+            self.ready[index] = batch, stages
+        self.ready.clear()
+        self.in_flight = 0
+
+    def close(self):
+
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=1)
+            if worker.is_alive(): worker.terminate()
+        self.workers = []
@@ -0,0 +1,91 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : preprocessed.py
+#   Author      : YunYang1994
+#   Created date: 2019-04-01 10:36:12
+#   Description : letterboxed dataset cache for core.dataset
+#
+#================================================================
+"""
+A preprocessed set is a directory of .npy arrays
+
+    images.npy       (N, S, S, 3)  uint8  the letterboxed RGB images at input size S
+    boxes.npy        (M, 5)        int32  xmin, ymin, xmax, ymax, class_id in letterboxed coordinates
+    box_offsets.npy  (N+1,)        int64  boxes of sample i are boxes[box_offsets[i]:box_offsets[i+1]]
+    source.npy       (4,)          int64  number of samples, S and the size and mtime of the annotations
+"""
+
+import os
+import numpy as np
+import core.utils as utils
+from core.annotation import save_array, temporary_path
+
+
+class PreprocessedSet(object):
+    """memory mapped preprocessed set, the arrays are mapped on first use and in every process that unpickles it"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.arrays    = None
+        self.num_samples, self.input_size = np.load(os.path.join(cache_dir, 'source.npy'))[:2]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def __len__(self):
+        return int(self.num_samples)
+
+    @staticmethod
+    def is_valid(cache_dir, num_samples, input_size, stamp):
+        source_path = os.path.join(cache_dir, 'source.npy')
+        return os.path.exists(source_path) and \
+               np.array_equal(np.load(source_path), np.concatenate([[num_samples, input_size], stamp]))
+
+    @staticmethod
+    def build(cache_dir, samples, num_samples, input_size, stamp):
+        """
+        letterbox the (image, bboxes) pairs of `samples` into a new preprocessed set. the trainers of every rank
+        may build it at once, the files are written under temporary names and replaced as a whole
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        images_path = os.path.join(cache_dir, 'images.npy')
+        images_tmp_path = temporary_path(images_path)
+        images = np.lib.format.open_memmap(images_tmp_path, mode='w+', dtype=np.uint8,
+                                           shape=(num_samples, input_size, input_size, 3))
+        boxes, box_offsets = [np.zeros((0, 5), dtype=np.int32)], [0]
+        for num, (image, bboxes) in enumerate(samples):
+            _, bboxes = utils.image_preporcess(np.copy(image), [input_size, input_size], np.copy(bboxes),
+                                               uint8=True, out=images[num])
+            boxes.append(np.reshape(bboxes, (-1, 5)).astype(np.int32))
+            box_offsets.append(box_offsets[-1] + len(boxes[-1]))
+        images.flush()
+        del images
+        os.replace(images_tmp_path, images_path)
+
+        save_array(os.path.join(cache_dir, 'boxes.npy'), np.concatenate(boxes, axis=0))
+        save_array(os.path.join(cache_dir, 'box_offsets.npy'), np.array(box_offsets, dtype=np.int64))
+        # written last, an interrupted build leaves no valid stamp behind
+        save_array(os.path.join(cache_dir, 'source.npy'), np.concatenate([[num_samples, input_size], stamp]))
+
+    def load(self):
+        if self.arrays is None:
+            self.arrays = {name: np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode='r')
+                           for name in ['images', 'boxes', 'box_offsets']}
+        return self.arrays
+
+    def read(self, index, out=None, uint8=False):
+        """write the letterboxed image of sample `index` into `out` and return it with its boxes"""
+        arrays = self.load()
+        if out is None:
+            out = np.empty(arrays['images'].shape[1:], dtype=np.uint8 if uint8 else np.float32)
+        if uint8:
+            out[...] = arrays['images'][index]
+        else:
+            np.divide(arrays['images'][index], 255., out=out)
+        start, end = arrays['box_offsets'][index], arrays['box_offsets'][index + 1]
+        return out, np.array(arrays['boxes'][start:end])
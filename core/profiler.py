@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : profiler.py
+#   Author      : YunYang1994
+#   Created date: 2019-03-29 16:02:57
+#   Description : wall time of the core.dataset loader stages
+#
+#================================================================
+
+import time
+import random
+import numpy as np
+from collections import OrderedDict
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class _Stage(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name     = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler(object):
+    """
+    collect the wall time of named stages with `with profiler.stage('decode'): ...`.
+    every stage keeps its exact call count and total time, and a bounded random sample
+    of the call times for the percentiles. a disabled profiler costs one attribute lookup.
+    """
+    NULL_STAGE = _NullStage()
+
+    def __init__(self, enabled=True, max_samples=10000):
+        self.enabled     = enabled
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        self.stages  = OrderedDict()
+        self.samples = 0
+        self.start   = time.time()
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else self.NULL_STAGE
+
+    def add(self, name, seconds):
+
+        if name not in self.stages:
+            self.stages[name] = [0, 0.0, []]
+        stage = self.stages[name]
+        stage[0] += 1
+        stage[1] += seconds
+        if len(stage[2]) < self.max_samples:
+            stage[2].append(seconds)
+        else:
+            index = random.randrange(stage[0])
+            if index < self.max_samples: stage[2][index] = seconds
+
+    def drain(self):
+        """return the stages collected so far and start over, for sending them out of a worker process"""
+        stages = self.stages
+        self.stages = OrderedDict()
+        return stages
+
+    def merge(self, stages):
+
+        for name, (count, total, times) in stages.items():
+            if name not in self.stages:
+                self.stages[name] = [0, 0.0, []]
+            stage = self.stages[name]
+            stage[0] += count
+            stage[1] += total
+            stage[2].extend(times)
+            if len(stage[2]) > self.max_samples:
+                stage[2] = random.sample(stage[2], self.max_samples)
+
+    def report(self, title='loader'):
+
+        elapsed = time.time() - self.start
+        lines = ["=> %s: %d samples in %.1fs, %.1f samples/s" % (title, self.samples, elapsed,
+                                                                   self.samples / max(elapsed, 1e-9))]
+        lines.append("   %-12s %9s %10s %9s %9s %9s %9s" % ('stage', 'calls', 'total(s)', 'mean(ms)',
+                                                          'p50(ms)', 'p90(ms)', 'p99(ms)'))
+        for name, (count, total, times) in self.stages.items():
+            p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000. if len(times) else (0., 0., 0.)
+            lines.append("   %-12s %9d %10.2f %9.2f %9.2f %9.2f %9.2f" % (name, count, total, 1000. * total / count,
+                                                                          p50, p90, p99))
+        return '\n'.join(lines)
@@ -0,0 +1,226 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : shard.py
+#   Author      : YunYang1994
+#   Created date: 2019-03-22 14:31:08
+#   Description : packed binary dataset shards
+#
+#================================================================
+"""
+A packed dataset is a directory of shards. Shard `00042` is made of
+
+    00042.bin   the images concatenated back to back, either the encoded image files or,
+                for raw shards, the decoded (height, width, 3) uint8 BGR pixels
+    00042.npz   the index of the shard:
+                    encoding     ()      str    'jpeg' or 'raw'
+                    offsets      (N+1,)  int64  byte range of image i is offsets[i]:offsets[i+1]
+                    sizes        (N, 2)  int32  (height, width) of image i
+                    scales       (N,)    float32  stored size / size of the original image
+                    box_offsets  (N+1,)  int64  boxes of image i are boxes[box_offsets[i]:box_offsets[i+1]]
+                    boxes        (M, 5)  int32  xmin, ymin, xmax, ymax, class_id in stored image coordinates
+                    paths        (N,)    str    the image path of the annotation file
+
+Create one from an annotation txt with
+
+    $ python -m core.shard --annot_path ./data/dataset/voc_train.txt --output_dir ./data/packed/voc_train
+
+For multi-scale training the images can be stored once, downscaled so their longest side fits the
+largest TRAIN.INPUT_SIZE, as raw pixels that are memory mapped without any decode
+
+    $ python -m core.shard --annot_path ./data/dataset/voc_train.txt --output_dir ./data/packed/voc_train_608 \\
+                           --max_side 608 --raw
+"""
+
+import os
+import cv2
+import argparse
+import numpy as np
+import core.utils as utils
+from core.annotation import parse_annotation_line
+
+
+def resize_max_side(image, bboxes, max_side):
+    """downscale the image so that its longest side is at most max_side, boxes are scaled to match"""
+    h, w, _ = image.shape
+    scale = 1.0 * max_side / max(h, w)
+    if scale >= 1.0: return image, bboxes, 1.0
+
+    nw, nh = max(int(round(w * scale)), 1), max(int(round(h * scale)), 1)
+    image = cv2.resize(image, (nw, nh), interpolation=cv2.INTER_AREA)
+    bboxes = np.copy(bboxes)
+    bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * (1.0 * nw / w)
+    bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * (1.0 * nh / h)
+    return image, bboxes, scale
+
+
+class ShardWriter(object):
+
+    def __init__(self, output_dir, shard_size=1000, encoding='jpeg'):
+        assert encoding in ['jpeg', 'raw']
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.encoding   = encoding
+        self.num_shards = 0
+        self.num_images = 0
+        self.reset()
+        if not os.path.exists(output_dir): os.makedirs(output_dir)
+
+    def reset(self):
+        self.data_file = None
+        self.offsets, self.sizes, self.scales, self.box_offsets, self.boxes, self.paths = [0], [], [], [0], [], []
+
+    def add(self, image_path, encoded, size, bboxes, scale=1.0):
+
+        if self.data_file is None:
+            self.data_file = open(os.path.join(self.output_dir, '%05d.bin' % self.num_shards), 'wb')
+        self.data_file.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+        self.sizes.append(size)
+        self.scales.append(scale)
+        self.box_offsets.append(self.box_offsets[-1] + len(bboxes))
+        self.boxes.append(bboxes)
+        self.paths.append(image_path)
+        self.num_images += 1
+
+        if len(self.paths) == self.shard_size: self.flush()
+
+    def flush(self):
+
+        if self.data_file is None: return
+        self.data_file.close()
+        np.savez(os.path.join(self.output_dir, '%05d.npz' % self.num_shards),
+                 encoding=np.array(self.encoding),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 sizes=np.array(self.sizes, dtype=np.int32).reshape(-1, 2),
+                 scales=np.array(self.scales, dtype=np.float32),
+                 box_offsets=np.array(self.box_offsets, dtype=np.int64),
+                 boxes=np.concatenate(self.boxes, axis=0).astype(np.int32).reshape(-1, 5),
+                 paths=np.array(self.paths))
+        self.num_shards += 1
+        self.reset()
+
+
+class PackedShards(object):
+    """
+    read a packed dataset, the image data of every shard is memory mapped on first use.
+    records are (shard, index) pairs.
+    """
+    def __init__(self, packed_dir):
+        self.packed_dir = packed_dir
+        shard_names = sorted(name[:-4] for name in os.listdir(packed_dir) if name.endswith('.npz'))
+        if len(shard_names) == 0:
+            raise KeyError("%s does not contain any shard ... " % packed_dir)
+
+        self.data_paths = [os.path.join(packed_dir, name + '.bin') for name in shard_names]
+        self.indexes = []
+        for name in shard_names:
+            with np.load(os.path.join(packed_dir, name + '.npz')) as index:
+                self.indexes.append({key: index[key] for key in index.files})
+        self.encodings = [str(index.get('encoding', 'jpeg')) for index in self.indexes]
+        self.data = [None] * len(shard_names)
+
+    def __getstate__(self):
+        # the memory maps are reopened in every process instead of being pickled
+        state = self.__dict__.copy()
+        state['data'] = [None] * len(self.data_paths)
+        return state
+
+    def __len__(self):
+        return sum(len(index['sizes']) for index in self.indexes)
+
+    def records(self):
+        return np.concatenate([np.stack([np.full(len(index['sizes']), shard, dtype=np.int32),
+                                         np.arange(len(index['sizes']), dtype=np.int32)], axis=-1)
+                               for shard, index in enumerate(self.indexes)], axis=0)
+
+    def shuffled_records(self, rng):
+        """shuffle the shard order and the images inside every shard, the shards are still read one at a time"""
+        records = []
+        for shard in rng.permutation(len(self.indexes)):
+            indices = rng.permutation(len(self.indexes[shard]['sizes'])).astype(np.int32)
+            records.append(np.stack([np.full(len(indices), shard, dtype=np.int32), indices], axis=-1))
+        return np.concatenate(records, axis=0)
+
+    def encoded(self, shard, index):
+
+        if self.data[shard] is None:
+            self.data[shard] = np.memmap(self.data_paths[shard], dtype=np.uint8, mode='r')
+        offsets = self.indexes[shard]['offsets']
+        return self.data[shard][offsets[index]:offsets[index + 1]]
+
+    def bboxes(self, shard, index):
+
+        box_offsets = self.indexes[shard]['box_offsets']
+        return np.array(self.indexes[shard]['boxes'][box_offsets[index]:box_offsets[index + 1]])
+
+    def path(self, shard, index):
+        return str(self.indexes[shard]['paths'][index])
+
+    def decode(self, shard, index):
+
+        if self.encodings[shard] == 'raw':
+            h, w = self.indexes[shard]['sizes'][index]
+            return self.encoded(shard, index).reshape(h, w, 3)
+
+        image = cv2.imdecode(self.encoded(shard, index), cv2.IMREAD_COLOR)
+        if image is None:
+            raise KeyError("%s can not be decoded ... " % self.path(shard, index))
+        return image
+
+    def decode_reduced(self, shard, index, target_size):
+        """decode at the largest jpeg reduction covering target_size, return the image and its (y, x) scale"""
+        if self.encodings[shard] == 'raw':
+            return self.decode(shard, index), (1.0, 1.0)
+        try:
+            return utils.imdecode_reduced(self.encoded(shard, index), target_size, self.indexes[shard]['sizes'][index])
+        except KeyError:
+            raise KeyError("%s can not be decoded ... " % self.path(shard, index))
+
+    def read(self, record):
+
+        shard, index = record
+        return self.decode(shard, index), self.bboxes(shard, index)
+
+
+def pack_annotations(annot_path, output_dir, shard_size=1000, max_side=0, raw=False):
+
+    writer = ShardWriter(output_dir, shard_size, 'raw' if raw else 'jpeg')
+    with open(annot_path, 'r') as f:
+        for line in f:
+            if len(line.strip().split()[1:]) == 0: continue
+            image_path, bboxes = parse_annotation_line(line)
+            with open(image_path, 'rb') as image_file:
+                encoded = image_file.read()
+            image = cv2.imdecode(np.frombuffer(encoded, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                print('=> skip %s, it can not be decoded' % image_path)
+                continue
+
+            scale = 1.0
+            if max_side > 0:
+                image, bboxes, scale = resize_max_side(image, bboxes, max_side)
+            if raw:
+                encoded = np.ascontiguousarray(image).tobytes()
+            elif scale < 1.0:
+                encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+            writer.add(image_path, encoded, image.shape[:2], bboxes, scale)
+    writer.flush()
+    return writer.num_images, writer.num_shards
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annot_path", default="./data/dataset/voc_train.txt")
+    parser.add_argument("--output_dir", default="./data/packed/voc_train")
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument("--max_side", type=int, default=0, help="downscale images whose longest side is larger")
+    parser.add_argument("--raw", action='store_true', help="store decoded uint8 pixels instead of jpeg")
+    flags = parser.parse_args()
+
+    num_images, num_shards = pack_annotations(flags.annot_path, flags.output_dir, flags.shard_size,
+                                              flags.max_side, flags.raw)
+    print('=> %d images packed into %d shards in %s' % (num_images, num_shards, flags.output_dir))
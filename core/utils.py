@@ -11,7 +11,9 @@
 #
 #================================================================
 
+import io
 import cv2
+import struct
 import random
 import colorsys
 import numpy as np
@@ -35,9 +37,119 @@ def get_anchors(anchors_path):
     return anchors.reshape(3, 3, 2)
 
 
-def image_preporcess(image, target_size, gt_boxes=None):
+def header_image_size(f):
+    """(height, width) from the header of a jpeg or png file object, None for other formats"""
+    head = f.read(26)
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = struct.unpack('>II', head[16:24])
+        return height, width
+
+    if head[:2] == b'\xff\xd8':
+        f.seek(2)
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff: break
+            if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7: continue
+            length = struct.unpack('>H', f.read(2))[0]
+            # start of frame markers, except DHT (c4), JPG (c8) and DAC (cc)
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                height, width = struct.unpack('>xHH', f.read(5))
+                return height, width
+            f.seek(length - 2, 1)
+    return None
+
+
+def read_image_size(image_path):
+    """return (height, width) of a jpeg or png file from its header, decoding it only for other formats"""
+    with open(image_path, 'rb') as f:
+        image_size = header_image_size(f)
+    if image_size is not None:
+        return image_size
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise KeyError("%s can not be decoded ... " % image_path)
+    return image.shape[:2]
+
+
+REDUCED_DECODE_FLAGS = {1: cv2.IMREAD_COLOR,
+                        2: cv2.IMREAD_REDUCED_COLOR_2,
+                        4: cv2.IMREAD_REDUCED_COLOR_4,
+                        8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def reduced_decode_factor(image_size, target_size):
+    """the largest jpeg decode reduction (1, 2, 4 or 8) which still covers the letterbox of the image in target_size"""
+    h, w = image_size
+    ih, iw = target_size
+    scale = min(1.0 * iw / w, 1.0 * ih / h)
+    for factor in (8, 4, 2):
+        if scale * factor <= 1.0: return factor
+    return 1
+
+
+def reduced_scale(image, image_size):
+    """(y, x) scale of a reduced decode relative to the full image size"""
+    h, w = image_size
+    if (image.shape[0] > image.shape[1]) != (h > w): h, w = w, h   # the decoder applied the exif rotation
+    return 1.0 * image.shape[0] / h, 1.0 * image.shape[1] / w
+
+
+def imdecode_reduced(encoded, target_size, image_size=None):
+    """
+    decode an encoded image (uint8 array) at the largest jpeg decode reduction (IMREAD_REDUCED_COLOR_*) which
+    still covers target_size, return the image and its (y, x) scale relative to the full size.
+    image_size is read from the jpeg header when not given, other formats are decoded at full size
+    """
+    is_jpeg = encoded[:2].tobytes() == b'\xff\xd8'
+    if is_jpeg and image_size is None:
+        image_size = header_image_size(io.BytesIO(encoded))
+    if not is_jpeg or image_size is None:
+        image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        if image is None:
+            raise KeyError("image can not be decoded ... ")
+        return image, (1.0, 1.0)
+
+    image = cv2.imdecode(encoded, REDUCED_DECODE_FLAGS[reduced_decode_factor(image_size, target_size)])
+    if image is None:
+        raise KeyError("image can not be decoded ... ")
+    return image, reduced_scale(image, image_size)
+
+
+def imread_reduced(image_path, target_size):
+    """read an image file with imdecode_reduced"""
+    try:
+        return imdecode_reduced(np.fromfile(image_path, dtype=np.uint8), target_size)
+    except KeyError:
+        raise KeyError("%s can not be decoded ... " % image_path)
+
+
+def scale_bboxes(bboxes, scale):
+    """scale the (N, 5) int boxes of an image to the (y, x) scale it was decoded at"""
+    if scale == (1.0, 1.0): return bboxes
+    bboxes = np.array(bboxes)
+    bboxes[:, [0, 2]] = np.round(bboxes[:, [0, 2]] * scale[1])
+    bboxes[:, [1, 3]] = np.round(bboxes[:, [1, 3]] * scale[0])
+    return bboxes
+
+
+def rect_input_size(aspect, input_size, stride=32):
+    """
+    the (height, width) network input for images of aspect ratio height / width:
+    the longest side is input_size and the other side is rounded up to a multiple of stride
+    """
+    if aspect < 1:
+        return int(np.ceil(input_size * aspect / stride) * stride), input_size
+    return input_size, int(np.ceil(input_size / aspect / stride) * stride)
+
 
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32)
+def image_preporcess(image, target_size, gt_boxes=None, uint8=False, out=None):
+    """
+    letterbox the image into target_size, with uint8=True the image stays in [0, 255] uint8
+    and the network scales it on device. `out` is an optional (ih, iw, 3) array to write into.
+    """
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if not uint8: image = image.astype(np.float32)
 
     ih, iw    = target_size
     h,  w, _  = image.shape
@@ -46,10 +158,22 @@ def image_preporcess(image, target_size, gt_boxes=None):
     nw, nh  = int(scale * w), int(scale * h)
     image_resized = cv2.resize(image, (nw, nh))
 
-    image_paded = np.full(shape=[ih, iw, 3], fill_value=128.0)
     dw, dh = (iw - nw) // 2, (ih-nh) // 2
-    image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
-    image_paded = image_paded / 255.
+    if out is not None:
+        image_paded = out
+        if uint8:
+            image_paded[...] = 128
+            image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
+        else:
+            image_paded[...] = 128.0 / 255.
+            np.divide(image_resized, 255., out=image_paded[dh:nh+dh, dw:nw+dw, :])
+    elif uint8:
+        image_paded = np.full(shape=[ih, iw, 3], fill_value=128, dtype=np.uint8)
+        image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
+    else:
+        image_paded = np.full(shape=[ih, iw, 3], fill_value=128.0)
+        image_paded[dh:nh+dh, dw:nw+dw, :] = image_resized
+        image_paded = image_paded / 255.
 
     if gt_boxes is None:
         return image_paded
@@ -117,7 +241,7 @@ def bboxes_iou(boxes1, boxes2):
 
 
 
-def read_pb_return_tensors(graph, pb_file, return_elements):
+def read_pb_return_tensors(graph, pb_file, return_elements, name='import'):
 
     with tf.gfile.FastGFile(pb_file, 'rb') as f:
         frozen_graph_def = tf.GraphDef()
@@ -125,10 +249,42 @@ def read_pb_return_tensors(graph, pb_file, return_elements):
 
     with graph.as_default():
         return_elements = tf.import_graph_def(frozen_graph_def,
-                                              return_elements=return_elements)
+                                              return_elements=return_elements, name=name)
     return return_elements
 
 
+# the input and the three prediction heads of a .pb written by freeze_graph.py
+FROZEN_RETURN_ELEMENTS = ["input/input_data:0", "output/pred_sbbox:0", "output/pred_mbbox:0", "output/pred_lbbox:0"]
+
+
+class FrozenGraphs(object):
+    """
+    the frozen graphs of freeze_graph.py for several input sizes, side by side in one graph and session.
+    every .pb is imported on first use under the scope size_<input size>
+    """
+    def __init__(self, pb_pattern="./checkpoint/yolov3_%d.pb", return_elements=FROZEN_RETURN_ELEMENTS):
+        self.pb_pattern      = pb_pattern
+        self.return_elements = return_elements
+        self.graph           = tf.Graph()
+        self.sess            = tf.Session(graph=self.graph, config=tf.ConfigProto(allow_soft_placement=True))
+        self.tensors         = {}
+
+    def get(self, input_size):
+        """the input placeholder and the prediction heads of the graph frozen at input_size"""
+        if input_size not in self.tensors:
+            self.tensors[input_size] = read_pb_return_tensors(self.graph, self.pb_pattern % input_size,
+                                                              self.return_elements, name='size_%d' % input_size)
+        return self.tensors[input_size]
+
+    def run(self, image_data):
+        """predict a batch of letterboxed images with the graph of its input size"""
+        input_data, pred_sbbox, pred_mbbox, pred_lbbox = self.get(image_data.shape[1])
+        return self.sess.run([pred_sbbox, pred_mbbox, pred_lbbox], feed_dict={input_data: image_data})
+
+    def close(self):
+        self.sess.close()
+
+
 def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
     """
     :param bboxes: (xmin, ymin, xmax, ymax, score, class)
@@ -167,7 +323,28 @@ def nms(bboxes, iou_threshold, sigma=0.3, method='nms'):
     return best_bboxes
 
 
+def decode_conv_output(conv_output, anchors, stride, num_classes, mobile=False):
+    """numpy version of YOLOV3.decode (decode_mobile with mobile) for the raw (B, h, w, A * (5 + C)) conv maps"""
+    batch_size, output_h, output_w = conv_output.shape[:3]
+    conv_output = np.reshape(conv_output, (batch_size, output_h, output_w, -1, 5 + num_classes))
+    x, y = np.meshgrid(np.arange(output_w), np.arange(output_h))
+    xy_grid = np.stack([x, y], axis=-1)[np.newaxis, :, :, np.newaxis, :].astype(np.float32)
+
+    if mobile:
+        pred_coor = np.concatenate([(xy_grid + 0.5 - np.exp(conv_output[..., 0:2])) * stride,
+                                    (xy_grid + 0.5 + np.exp(conv_output[..., 2:4])) * stride], axis=-1)
+    else:
+        pred_coor = np.concatenate([(sigmoid(conv_output[..., 0:2]) + xy_grid) * stride,
+                                    (np.exp(conv_output[..., 2:4]) * anchors) * stride], axis=-1)
+    return np.concatenate([pred_coor, sigmoid(conv_output[..., 4:5]), sigmoid(conv_output[..., 5:])], axis=-1)
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
 def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
+    """input_size is the side of the square network input, or its (height, width) for rectangular inputs"""
 
     valid_scale=[0, np.inf]
     pred_bbox = np.array(pred_bbox)
@@ -181,10 +358,11 @@ def postprocess_boxes(pred_bbox, org_img_shape, input_size, score_threshold):
                                 pred_xywh[:, :2] + pred_xywh[:, 2:] * 0.5], axis=-1)
     # # (2) (xmin, ymin, xmax, ymax) -> (xmin_org, ymin_org, xmax_org, ymax_org)
     org_h, org_w = org_img_shape
-    resize_ratio = min(input_size / org_w, input_size / org_h)
+    input_h, input_w = input_size if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+    resize_ratio = min(input_w / org_w, input_h / org_h)
 
-    dw = (input_size - resize_ratio * org_w) / 2
-    dh = (input_size - resize_ratio * org_h) / 2
+    dw = (input_w - resize_ratio * org_w) / 2
+    dh = (input_h - resize_ratio * org_h) / 2
 
     pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
     pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
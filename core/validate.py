@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : validate.py
+#   Author      : YunYang1994
+#   Created date: 2019-04-02 15:47:20
+#   Description : check an annotation txt once before training
+#
+#================================================================
+"""
+Every line of an annotation txt is checked once, in a pool of processes
+
+    - the image exists and can be decoded
+    - the class ids are in [0, number of classes)
+    - the boxes are clipped to the image, the ones left empty are dropped
+
+and the result is written next to the txt
+
+    voc_train.valid.txt          the lines which passed, with their clipped boxes
+    voc_train.valid.txt.index    the compiled annotation index of them, with the image sizes
+    voc_train.rejects.txt        line number, reason and content of every rejected line or dropped box
+
+so the loader never needs to look at the filesystem before reading an image. Train on the clean txt with
+__C.TRAIN.ANNOT_PATH = "./data/dataset/voc_train.valid.txt" after
+
+    $ python -m core.validate --annot_path ./data/dataset/voc_train.txt --num_workers 8
+"""
+
+import cv2
+import argparse
+import numpy as np
+import multiprocessing
+import core.utils as utils
+from core.config import cfg
+from core.annotation import parse_annotation_line, compile_annotations
+
+
+def default_output_paths(annot_path):
+    stem = annot_path[:-4] if annot_path.endswith('.txt') else annot_path
+    return stem + '.valid.txt', stem + '.rejects.txt'
+
+
+def check_line(task):
+    """
+    return the clean line, the (height, width) of its image and the rejects of line `line_number`,
+    the clean line is None when the whole line is rejected
+    """
+    line_number, line, num_classes = task
+    line = line.strip()
+    try:
+        image_path, bboxes = parse_annotation_line(line)
+    except ValueError:
+        return None, None, [(line_number, 'can not be parsed', line)]
+    if len(bboxes) == 0:
+        return None, None, [(line_number, 'has no box', line)]
+
+    try:
+        encoded = np.fromfile(image_path, dtype=np.uint8)
+    except IOError:
+        return None, None, [(line_number, 'image does not exist', line)]
+    try:
+        image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+    except cv2.error:
+        # an empty file fails the buffer check of imdecode instead of returning None
+        image = None
+    if image is None:
+        return None, None, [(line_number, 'image can not be decoded', line)]
+    h, w = image.shape[:2]
+
+    bad_class = (bboxes[:, 4] < 0) | (bboxes[:, 4] >= num_classes)
+    if np.any(bad_class):
+        return None, None, [(line_number, 'class id out of range', line)]
+
+    clipped = np.copy(bboxes)
+    clipped[:, [0, 2]] = np.clip(clipped[:, [0, 2]], 0, w)
+    clipped[:, [1, 3]] = np.clip(clipped[:, [1, 3]], 0, h)
+    empty = (clipped[:, 2] <= clipped[:, 0]) | (clipped[:, 3] <= clipped[:, 1])
+    rejects = [(line_number, 'box outside the %dx%d image' % (w, h), ','.join(map(str, box)))
+               for box in bboxes[empty]]
+    if np.all(empty):
+        return None, None, rejects + [(line_number, 'has no box inside the image', line)]
+
+    clean_line = ' '.join([image_path] + [','.join(map(str, box)) for box in clipped[~empty]])
+    return clean_line, (h, w), rejects
+
+
+def validate_annotations(annot_path, valid_path=None, rejects_path=None, num_classes=None, num_workers=None):
+    """check every line of annot_path, write the clean txt with its index and the rejects report"""
+    default_valid_path, default_rejects_path = default_output_paths(annot_path)
+    valid_path = default_valid_path if valid_path is None else valid_path
+    rejects_path = default_rejects_path if rejects_path is None else rejects_path
+    num_classes = len(utils.read_class_names(cfg.YOLO.CLASSES)) if num_classes is None else num_classes
+
+    with open(annot_path, 'r') as f:
+        tasks = [(line_number, line, num_classes) for line_number, line in enumerate(f, 1) if len(line.strip())]
+
+    num_lines, sizes = 0, []
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        with open(valid_path, 'w') as valid_file, open(rejects_path, 'w') as rejects_file:
+            for clean_line, image_size, rejects in pool.imap(check_line, tasks, chunksize=64):
+                for reject in rejects:
+                    rejects_file.write('%d\t%s\t%s\n' % reject)
+                if clean_line is None: continue
+                valid_file.write(clean_line + '\n')
+                sizes.append(image_size)
+                num_lines += 1
+    finally:
+        pool.terminate()
+
+    compile_annotations(valid_path, sizes=sizes)
+    return num_lines, len(tasks) - num_lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--annot_path", default="./data/dataset/voc_train.txt")
+    parser.add_argument("--valid_path", default=None, help="default: <annot_path>.valid.txt")
+    parser.add_argument("--rejects_path", default=None, help="default: <annot_path>.rejects.txt")
+    parser.add_argument("--num_classes", type=int, default=None, help="default: the classes of YOLO.CLASSES")
+    parser.add_argument("--num_workers", type=int, default=None, help="default: one per cpu")
+    flags = parser.parse_args()
+
+    num_valid, num_rejected = validate_annotations(flags.annot_path, flags.valid_path, flags.rejects_path,
+                                                   flags.num_classes, flags.num_workers)
+    valid_path, rejects_path = default_output_paths(flags.annot_path)
+    print('=> %d lines kept in %s, %d rejected, see %s' % (num_valid, flags.valid_path or valid_path, num_rejected,
+                                                          flags.rejects_path or rejects_path))
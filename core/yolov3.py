@@ -33,10 +33,16 @@ class YOLOV3(object):
         
         self.mobile           = cfg.YOLO.BACKBONE_MOBILE
         self.gt_per_grid      = cfg.YOLO.GT_PER_GRID
+        self.precision        = tf.as_dtype(cfg.YOLO.PRECISION)
+
+        if input_data.dtype == tf.uint8:
+            with tf.name_scope('input_normalization'):
+                input_data = tf.cast(input_data, tf.float32) / 255.
         
         if self.mobile:
             try:
-                self.conv_lbbox, self.conv_mbbox, self.conv_sbbox = self.__build_nework_mobile(input_data)
+                self.conv_lbbox, self.conv_mbbox, self.conv_sbbox = self.build_network(self.__build_nework_mobile,
+                                                                                       input_data)
             except:
                 raise NotImplementedError("Can not build up yolov3 network!")
 
@@ -52,7 +58,7 @@ class YOLOV3(object):
         else:
             
             try:
-                self.conv_lbbox, self.conv_mbbox, self.conv_sbbox = self.__build_nework(input_data)
+                self.conv_lbbox, self.conv_mbbox, self.conv_sbbox = self.build_network(self.__build_nework, input_data)
             except:
                 raise NotImplementedError("Can not build up yolov3 network!")
 
@@ -65,6 +71,20 @@ class YOLOV3(object):
             with tf.variable_scope('pred_lbbox'):
                 self.pred_lbbox = self.decode(self.conv_lbbox, self.anchors[2], self.strides[2])
 
+    def build_network(self, build, input_data):
+        """
+        build the layers in YOLO.PRECISION. in float16 or bfloat16 they read float32 variables, named as in the
+        float32 network, through common.float32_variable_getter, and the heads are cast back to float32 for the
+        decoding and the loss
+        """
+        if self.precision == tf.float32:
+            return build(input_data)
+
+        with tf.variable_scope(tf.get_variable_scope(), custom_getter=common.float32_variable_getter,
+                               auxiliary_name_scope=False):
+            conv_heads = build(tf.cast(input_data, self.precision))
+        return [tf.cast(conv_head, tf.float32) for conv_head in conv_heads]
+
     def __build_nework_mobile(self, input_data):
         
         feature_map_s, feature_map_m, feature_map_l = backbone.MobilenetV2(input_data, self.trainable)
@@ -181,24 +201,40 @@ class YOLOV3(object):
 
         return conv_lbbox, conv_mbbox, conv_sbbox
 
+    def conv_dims(self, conv_output):
+        """batch size, height and width of conv_output, as python ints where its shape is static"""
+        conv_shape = tf.shape(conv_output)
+        static_shape = conv_output.shape.as_list() if conv_output.shape.ndims is not None else [None] * 4
+        return [conv_shape[i] if static_shape[i] is None else static_shape[i] for i in range(3)]
+
+    def xy_grid(self, batch_size, output_h, output_w, num_anchors):
+        """
+        the (x, y) cell of every prediction. for a static shape it is a (1, h, w, 1, 2) constant
+        which broadcasts over the batch and the anchors, instead of being rebuilt on every run
+        """
+        if isinstance(output_h, int) and isinstance(output_w, int):
+            x, y = np.meshgrid(np.arange(output_w), np.arange(output_h))
+            return tf.constant(np.stack([x, y], axis=-1)[np.newaxis, :, :, np.newaxis, :], dtype=tf.float32)
+
+        y = tf.tile(tf.range(output_h, dtype=tf.int32)[:, tf.newaxis], [1, output_w])
+        x = tf.tile(tf.range(output_w, dtype=tf.int32)[tf.newaxis, :], [output_h, 1])
+
+        xy_grid = tf.concat([x[:, :, tf.newaxis], y[:, :, tf.newaxis]], axis=-1)
+        xy_grid = tf.tile(xy_grid[tf.newaxis, :, :, tf.newaxis, :], [batch_size, 1, 1, num_anchors, 1])
+        return tf.cast(xy_grid, tf.float32)
+
     def decode_mobile(self, conv_output, num_classes, stride):
         
-        conv_shape = tf.shape(conv_output)
-        batch_size = conv_shape[0]
-        output_size = conv_shape[1]
-        gt_per_grid = conv_shape[3] // (5 + num_classes)
+        batch_size, output_h, output_w = self.conv_dims(conv_output)
+        gt_per_grid = self.gt_per_grid
 
-        conv_output = tf.reshape(conv_output, (batch_size, output_size, output_size, gt_per_grid, 5 + num_classes))
+        conv_output = tf.reshape(conv_output, (batch_size, output_h, output_w, gt_per_grid, 5 + num_classes))
         conv_raw_dx1dy1 = conv_output[:, :, :, :, 0:2]
         conv_raw_dx2dy2 = conv_output[:, :, :, :, 2:4]
         conv_raw_conf = conv_output[:, :, :, :, 4:5]
         conv_raw_prob = conv_output[:, :, :, :, 5:]
 
-        y = tf.tile(tf.range(output_size, dtype=tf.int32)[:, tf.newaxis], [1, output_size])
-        x = tf.tile(tf.range(output_size, dtype=tf.int32)[tf.newaxis, :], [output_size, 1])
-        xy_grid = tf.concat([x[:, :, tf.newaxis], y[:, :, tf.newaxis]], axis=-1)
-        xy_grid = tf.tile(xy_grid[tf.newaxis, :, :, tf.newaxis, :], [batch_size, 1, 1, gt_per_grid, 1])
-        xy_grid = tf.cast(xy_grid, tf.float32)
+        xy_grid = self.xy_grid(batch_size, output_h, output_w, gt_per_grid)
 
         pred_xymin = (xy_grid + 0.5 - tf.exp(conv_raw_dx1dy1)) * stride
         pred_xymax = (xy_grid + 0.5 + tf.exp(conv_raw_dx2dy2)) * stride
@@ -213,28 +249,21 @@ class YOLOV3(object):
         
     def decode(self, conv_output, anchors, stride):
         """
-        return tensor of shape [batch_size, output_size, output_size, anchor_per_scale, 5 + num_classes]
+        return tensor of shape [batch_size, output_h, output_w, anchor_per_scale, 5 + num_classes]
                contains (x, y, w, h, score, probability)
         """
 
-        conv_shape       = tf.shape(conv_output)
-        batch_size       = conv_shape[0]
-        output_size      = conv_shape[1]
+        batch_size, output_h, output_w = self.conv_dims(conv_output)
         anchor_per_scale = len(anchors)
 
-        conv_output = tf.reshape(conv_output, (batch_size, output_size, output_size, anchor_per_scale, 5 + self.num_class))
+        conv_output = tf.reshape(conv_output, (batch_size, output_h, output_w, anchor_per_scale, 5 + self.num_class))
 
         conv_raw_dxdy = conv_output[:, :, :, :, 0:2]
         conv_raw_dwdh = conv_output[:, :, :, :, 2:4]
         conv_raw_conf = conv_output[:, :, :, :, 4:5]
         conv_raw_prob = conv_output[:, :, :, :, 5: ]
 
-        y = tf.tile(tf.range(output_size, dtype=tf.int32)[:, tf.newaxis], [1, output_size])
-        x = tf.tile(tf.range(output_size, dtype=tf.int32)[tf.newaxis, :], [output_size, 1])
-
-        xy_grid = tf.concat([x[:, :, tf.newaxis], y[:, :, tf.newaxis]], axis=-1)
-        xy_grid = tf.tile(xy_grid[tf.newaxis, :, :, tf.newaxis, :], [batch_size, 1, 1, anchor_per_scale, 1])
-        xy_grid = tf.cast(xy_grid, tf.float32)
+        xy_grid = self.xy_grid(batch_size, output_h, output_w, anchor_per_scale)
 
         pred_xy = (tf.sigmoid(conv_raw_dxdy) + xy_grid) * stride
         pred_wh = (tf.exp(conv_raw_dwdh) * anchors) * stride
@@ -300,14 +329,159 @@ class YOLOV3(object):
 
         return iou
 
+    def build_labels(self, gt_boxes):
+        """
+        in graph version of Dataset.preprocess_true_boxes_batch, for TRAIN.GRAPH_LABELS.
+        encode the padded (B, N, 5) ground truth boxes, whose padding rows have class -1, into the label grids
+        and the (B, 150, 4) box lists of the three scales with the same rules: a box responds on every anchor
+        with iou > 0.3 (or on its best anchor if there is none), and the last box wins a shared anchor.
+        """
+        max_bbox_per_scale = 150
+        batch_size = tf.shape(gt_boxes, out_type=tf.int64)[0]
+        valid = gt_boxes[..., 4] >= 0
+        bbox_coor = gt_boxes[..., 0:4]
+        bbox_class_ind = tf.cast(tf.maximum(gt_boxes[..., 4], 0), tf.int32)
+
+        onehot = tf.one_hot(bbox_class_ind, self.num_class)
+        deta = 0.01
+        smooth_onehot = onehot * (1 - deta) + deta / self.num_class
+
+        bbox_xywh = tf.concat([(bbox_coor[..., 2:] + bbox_coor[..., :2]) * 0.5,
+                               bbox_coor[..., 2:] - bbox_coor[..., :2]], axis=-1)
+        iou, grid_xy = [], []
+        for i in range(3):
+            bbox_xywh_scaled = bbox_xywh / self.strides[i]
+            grid_xy.append(tf.floor(bbox_xywh_scaled[..., 0:2]))
+            anchors_xy = grid_xy[i][:, :, np.newaxis, :] + 0.5 + tf.zeros((1, 1, self.anchor_per_scale, 2))
+            anchors_wh = tf.zeros_like(anchors_xy) + np.array(self.anchors[i], dtype=np.float32)
+            anchors_xywh = tf.concat([anchors_xy, anchors_wh], axis=-1)
+            iou.append(self.bbox_iou(bbox_xywh_scaled[:, :, np.newaxis, :], anchors_xywh))
+
+        iou = tf.stack(iou, axis=2)
+        respond = iou > 0.3
+        no_positive = tf.logical_not(tf.reduce_any(respond, axis=[2, 3]))
+        best_anchor_ind = tf.argmax(tf.reshape(iou, (tf.shape(iou)[0], tf.shape(iou)[1], 3 * self.anchor_per_scale)), axis=-1)
+        best_anchor = tf.reshape(tf.one_hot(best_anchor_ind, 3 * self.anchor_per_scale, on_value=True, off_value=False),
+                                 tf.shape(respond))
+        respond = tf.logical_or(respond, tf.logical_and(no_positive[:, :, np.newaxis, np.newaxis], best_anchor))
+        respond = tf.logical_and(respond, valid[:, :, np.newaxis, np.newaxis])
+
+        labels, true_bboxes = [], []
+        for i, conv in enumerate([self.conv_sbbox, self.conv_mbbox, self.conv_lbbox]):
+            output_h = tf.shape(conv, out_type=tf.int64)[1]
+            output_w = tf.shape(conv, out_type=tf.int64)[2]
+
+            box_ind = tf.where(respond[:, :, i, :])
+            grid = tf.cast(tf.gather_nd(grid_xy[i], box_ind[:, 0:2]), tf.int64)
+            xind, yind = tf.floormod(grid[:, 0], output_w), tf.floormod(grid[:, 1], output_h)
+            cell = ((box_ind[:, 0] * output_h + yind) * output_w + xind) * self.anchor_per_scale + box_ind[:, 2]
+            num_cells = batch_size * output_h * output_w * self.anchor_per_scale
+            last_box = tf.unsorted_segment_max(tf.cast(box_ind[:, 1], tf.int32), cell, num_cells)
+            keep = tf.equal(tf.cast(box_ind[:, 1], tf.int32), tf.gather(last_box, cell))
+            box_ind, xind, yind = tf.boolean_mask(box_ind, keep), tf.boolean_mask(xind, keep), tf.boolean_mask(yind, keep)
+
+            label_xywh = tf.gather_nd(bbox_xywh, box_ind[:, 0:2])
+            label_value = tf.concat([label_xywh, tf.ones_like(label_xywh[:, 0:1]),
+                                     tf.gather_nd(smooth_onehot, box_ind[:, 0:2])], axis=-1)
+            labels.append(tf.scatter_nd(tf.stack([box_ind[:, 0], yind, xind, box_ind[:, 2]], axis=-1), label_value,
+                                        tf.stack([batch_size, output_h, output_w, np.int64(self.anchor_per_scale),
+                                                  np.int64(5 + self.num_class)])))
+
+            respond_scale = tf.reduce_any(respond[:, :, i, :], axis=-1)
+            rank = tf.cumsum(tf.cast(respond_scale, tf.int64), axis=1) - 1
+            count = tf.reduce_sum(tf.cast(respond_scale, tf.int64), axis=1, keepdims=True)
+            box_ind = tf.where(tf.logical_and(respond_scale, rank >= count - max_bbox_per_scale))
+            slot = tf.floormod(tf.gather_nd(rank, box_ind), max_bbox_per_scale)
+            true_bboxes.append(tf.scatter_nd(tf.stack([box_ind[:, 0], slot], axis=-1), tf.gather_nd(bbox_xywh, box_ind),
+                                             tf.stack([batch_size, np.int64(max_bbox_per_scale), np.int64(4)])))
+
+        return labels[0], labels[1], labels[2], true_bboxes[0], true_bboxes[1], true_bboxes[2]
+
+    def postprocess(self, org_sizes, input_size, score_threshold, iou_threshold, max_det=100, method='nms',
+                    sigma=0.3, max_candidates=1000):
+        """
+        in graph version of utils.postprocess_boxes and utils.nms for a batch, an optional tail of the three heads.
+        org_sizes are the (B, 2) original (height, width) of the images and input_size is the side or the
+        (height, width) of the network input, ints or scalar tensors. the per class nms greedily picks max_det
+        boxes out of the max_candidates best ones of every image, and returns them as (B, max_det, 6)
+        xmin, ymin, xmax, ymax, score, class rows. the padding rows have score 0 and class -1
+        """
+        assert method in ['nms', 'soft-nms']
+        pred_bbox = tf.concat([tf.reshape(pred, (tf.shape(pred)[0], -1, 5 + self.num_class))
+                               for pred in [self.pred_sbbox, self.pred_mbbox, self.pred_lbbox]], axis=1)
+        pred_coor, pred_conf, pred_prob = pred_bbox[..., 0:4], pred_bbox[..., 4], pred_bbox[..., 5:]
+        if not self.mobile:
+            # decode_mobile already predicts the corners
+            pred_coor = tf.concat([pred_coor[..., :2] - pred_coor[..., 2:] * 0.5,
+                                   pred_coor[..., :2] + pred_coor[..., 2:] * 0.5], axis=-1)
+
+        # (xmin, ymin, xmax, ymax) in the letterboxed input -> in the original image, clipped to it
+        org_sizes = tf.cast(org_sizes, tf.float32)
+        org_h, org_w = org_sizes[:, 0:1], org_sizes[:, 1:2]
+        input_h, input_w = input_size if isinstance(input_size, (tuple, list)) else (input_size, input_size)
+        input_h, input_w = tf.cast(input_h, tf.float32), tf.cast(input_w, tf.float32)
+        resize_ratio = tf.minimum(input_w / org_w, input_h / org_h)
+        dw = (input_w - resize_ratio * org_w) / 2
+        dh = (input_h - resize_ratio * org_h) / 2
+        xmin = tf.maximum((pred_coor[..., 0] - dw) / resize_ratio, 0.)
+        ymin = tf.maximum((pred_coor[..., 1] - dh) / resize_ratio, 0.)
+        xmax = tf.minimum((pred_coor[..., 2] - dw) / resize_ratio, org_w - 1)
+        ymax = tf.minimum((pred_coor[..., 3] - dh) / resize_ratio, org_h - 1)
+        pred_coor = tf.stack([xmin, ymin, xmax, ymax], axis=-1)
+
+        # empty boxes and low scores get a zero score, which nms never picks
+        classes = tf.argmax(pred_prob, axis=-1, output_type=tf.int32)
+        scores = pred_conf * tf.reduce_max(pred_prob, axis=-1)
+        keep = tf.logical_and(tf.logical_and(xmin < xmax, ymin < ymax), scores > score_threshold)
+        scores = tf.where(keep, scores, tf.zeros_like(scores))
+
+        num_candidates = tf.minimum(max_candidates, tf.shape(scores)[1])
+        scores, indices = tf.nn.top_k(scores, k=num_candidates)
+        batch_ind = tf.tile(tf.range(tf.shape(scores)[0])[:, tf.newaxis], [1, num_candidates])
+        boxes = tf.gather_nd(pred_coor, tf.stack([batch_ind, indices], axis=-1))
+        classes = tf.gather_nd(classes, tf.stack([batch_ind, indices], axis=-1))
+        areas = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+        def select(i, scores, detections):
+            best = tf.argmax(scores, axis=1, output_type=tf.int32)
+            best_ind = tf.stack([tf.range(tf.shape(scores)[0]), best], axis=-1)
+            best_score = tf.gather_nd(scores, best_ind)
+            best_box = tf.gather_nd(boxes, best_ind)
+            best_class = tf.gather_nd(classes, best_ind)
+
+            left_up = tf.maximum(best_box[:, tf.newaxis, :2], boxes[..., :2])
+            right_down = tf.minimum(best_box[:, tf.newaxis, 2:], boxes[..., 2:])
+            inter_section = tf.maximum(right_down - left_up, 0.0)
+            inter_area = inter_section[..., 0] * inter_section[..., 1]
+            union_area = tf.gather_nd(areas, best_ind)[:, tf.newaxis] + areas - inter_area
+            iou = inter_area / tf.maximum(union_area, 1e-10)
+
+            same_class = tf.equal(classes, best_class[:, tf.newaxis])
+            if method == 'nms':
+                weight = tf.where(tf.logical_and(same_class, iou > iou_threshold), tf.zeros_like(iou), tf.ones_like(iou))
+            else:
+                weight = tf.where(same_class, tf.exp(-(1.0 * iou ** 2 / sigma)), tf.ones_like(iou))
+            scores = scores * weight * (1. - tf.one_hot(best, tf.shape(scores)[1]))
+
+            detection = tf.concat([best_box, best_score[:, tf.newaxis],
+                                   tf.cast(best_class, tf.float32)[:, tf.newaxis]], axis=-1)
+            padding = tf.concat([tf.zeros_like(detection[:, :5]), -tf.ones_like(detection[:, 5:])], axis=-1)
+            detection = tf.where(best_score > 0., detection, padding)
+            return i + 1, scores, detections.write(i, detection)
+
+        _, _, detections = tf.while_loop(lambda i, scores, detections: i < max_det, select,
+                                         [tf.constant(0), scores, tf.TensorArray(tf.float32, size=max_det)])
+        return tf.transpose(detections.stack(), [1, 0, 2])
+
     def loss_layer(self, conv, pred, label, bboxes, anchors, stride):
 
         conv_shape  = tf.shape(conv)
         batch_size  = conv_shape[0]
-        output_size = conv_shape[1]
-        input_size  = stride * output_size
+        output_h    = conv_shape[1]
+        output_w    = conv_shape[2]
+        input_area  = (stride * output_h) * (stride * output_w)
         
-        conv = tf.reshape(conv, (batch_size, output_size, output_size,
+        conv = tf.reshape(conv, (batch_size, output_h, output_w,
                             self.gt_per_grid, 5 + self.num_class))
 
         conv_raw_conf = conv[:, :, :, :, 4:5]
@@ -321,9 +495,9 @@ class YOLOV3(object):
         label_prob    = label[:, :, :, :, 5:]
 
         giou = tf.expand_dims(self.bbox_giou(pred_xywh, label_xywh), axis=-1)
-        input_size = tf.cast(input_size, tf.float32)
+        input_area = tf.cast(input_area, tf.float32)
 
-        bbox_loss_scale = 2.0 - 1.0 * label_xywh[:, :, :, :, 2:3] * label_xywh[:, :, :, :, 3:4] / (input_size ** 2)
+        bbox_loss_scale = 2.0 - 1.0 * label_xywh[:, :, :, :, 2:3] * label_xywh[:, :, :, :, 3:4] / input_area
         giou_loss = respond_bbox * bbox_loss_scale * (1- giou)
 
         iou = self.bbox_iou(pred_xywh[:, :, :, :, np.newaxis, :], bboxes[:, np.newaxis, np.newaxis, np.newaxis, :, :])
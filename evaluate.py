@@ -13,12 +13,15 @@
 
 import cv2
 import os
+import time
 import shutil
 import numpy as np
 import tensorflow as tf
 import core.utils as utils
+import core.common as common
 from core.config import cfg
 from core.yolov3 import YOLOV3
+from core.annotation import load_annotation_index
 
 class YoloTest(object):
     def __init__(self):
@@ -35,41 +38,95 @@ class YoloTest(object):
         self.write_image      = cfg.TEST.WRITE_IMAGE
         self.write_image_path = cfg.TEST.WRITE_IMAGE_PATH
         self.show_label       = cfg.TEST.SHOW_LABEL
+        self.uint8_input      = cfg.YOLO.INPUT_UINT8
+        self.rect             = cfg.TEST.RECT
+        self.reduced_decode   = cfg.TEST.REDUCED_DECODE
+        self.max_stride       = max(cfg.YOLO.STRIDES)
+        self.folded_bn        = cfg.TEST.FOLDED_BN
+        self.graph_nms        = cfg.TEST.GRAPH_NMS
+        self.mobile           = cfg.YOLO.BACKBONE_MOBILE
+        self.latencies        = []
+        self.load_model()
+
+    def load_model(self):
 
         with tf.name_scope('input'):
-            self.input_data = tf.placeholder(dtype=tf.float32, name='input_data')
+            self.input_data = tf.placeholder(dtype=tf.uint8 if self.uint8_input else tf.float32, name='input_data')
             self.trainable  = tf.placeholder(dtype=tf.bool,    name='trainable')
 
-        model = YOLOV3(self.input_data, self.trainable)
+        # a checkpoint of fold_batchnorm.py holds the folded moving averages under the plain variable names
+        model = YOLOV3(self.input_data, common.FOLDED_BN if self.folded_bn else self.trainable)
         self.pred_sbbox, self.pred_mbbox, self.pred_lbbox = model.pred_sbbox, model.pred_mbbox, model.pred_lbbox
+        if self.graph_nms:
+            # only the (1, MAX_DETECTIONS, 6) boxes come back from the device
+            self.org_sizes  = tf.placeholder(dtype=tf.float32, shape=[None, 2], name='org_sizes')
+            input_shape     = tf.shape(self.input_data)
+            self.detections = model.postprocess(self.org_sizes, (input_shape[1], input_shape[2]), self.score_threshold,
+                                                self.iou_threshold, cfg.TEST.MAX_DETECTIONS, cfg.TEST.NMS_METHOD)
 
         with tf.name_scope('ema'):
             ema_obj = tf.train.ExponentialMovingAverage(self.moving_ave_decay)
 
         self.sess  = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
-        self.saver = tf.train.Saver(ema_obj.variables_to_restore())
+        self.saver = tf.train.Saver(tf.global_variables() if self.folded_bn else ema_obj.variables_to_restore())
         self.saver.restore(self.sess, self.weight_file)
 
-    def predict(self, image):
+    def run_model(self, image_data):
+        """the three prediction maps of a batch of letterboxed images"""
+        return self.sess.run([self.pred_sbbox, self.pred_mbbox, self.pred_lbbox],
+                             feed_dict={self.input_data: image_data, self.trainable: False})
+
+    def network_input_size(self, org_h, org_w):
+
+        if self.rect:
+            return utils.rect_input_size(1.0 * org_h / org_w, self.input_size, self.max_stride)
+        return (self.input_size, self.input_size)
 
+    def read_image(self, image_path):
+        """
+        read an image for predict, with TEST.REDUCED_DECODE a jpeg is decoded at the largest reduction
+        which still covers the network input. return the image and its (y, x) scale to the full size
+        """
+        if not self.reduced_decode:
+            return cv2.imread(image_path), (1.0, 1.0)
+        org_h, org_w = utils.read_image_size(image_path)
+        return utils.imread_reduced(image_path, self.network_input_size(org_h, org_w))
+
+    def predict(self, image, scale=(1.0, 1.0)):
+        """the predicted boxes of the image, divided by its decode scale so they are in full size coordinates"""
         org_image = np.copy(image)
         org_h, org_w, _ = org_image.shape
 
-        image_data = utils.image_preporcess(image, [self.input_size, self.input_size])
+        input_size = self.network_input_size(org_h, org_w)
+        image_data = utils.image_preporcess(image, list(input_size), uint8=self.uint8_input)
         image_data = image_data[np.newaxis, ...]
 
-        pred_sbbox, pred_mbbox, pred_lbbox = self.sess.run(
-            [self.pred_sbbox, self.pred_mbbox, self.pred_lbbox],
-            feed_dict={
-                self.input_data: image_data,
-                self.trainable: False
-            }
-        )
+        if self.graph_nms:
+            start = time.time()
+            detections = self.sess.run(self.detections, feed_dict={self.input_data: image_data,
+                                                                    self.org_sizes: [[org_h, org_w]],
+                                                                    self.trainable: False})
+            self.latencies.append(time.time() - start)
+            bboxes = detections[0][detections[0][:, 4] > 0]
+            bboxes[:, [0, 2]] = bboxes[:, [0, 2]] / scale[1]
+            bboxes[:, [1, 3]] = bboxes[:, [1, 3]] / scale[0]
+            return list(bboxes)
+
+        start = time.time()
+        pred_sbbox, pred_mbbox, pred_lbbox = self.run_model(image_data)
+        self.latencies.append(time.time() - start)
 
         pred_bbox = np.concatenate([np.reshape(pred_sbbox, (-1, 5 + self.num_classes)),
                                     np.reshape(pred_mbbox, (-1, 5 + self.num_classes)),
                                     np.reshape(pred_lbbox, (-1, 5 + self.num_classes))], axis=0)
-        bboxes = utils.postprocess_boxes(pred_bbox, (org_h, org_w), self.input_size, self.score_threshold)
+        if self.mobile:
+            # decode_mobile predicts the corners, postprocess_boxes takes the centre and size
+            pred_bbox[:, 0:4] = np.concatenate([(pred_bbox[:, 0:2] + pred_bbox[:, 2:4]) * 0.5,
+                                                pred_bbox[:, 2:4] - pred_bbox[:, 0:2]], axis=-1)
+        bboxes = utils.postprocess_boxes(pred_bbox, (org_h, org_w), input_size, self.score_threshold)
+        if scale != (1.0, 1.0):
+            bboxes[:, [0, 2]] = bboxes[:, [0, 2]] / scale[1]
+            bboxes[:, [1, 3]] = bboxes[:, [1, 3]] / scale[0]
         bboxes = utils.nms(bboxes, self.iou_threshold)
 
         return bboxes
@@ -84,49 +141,50 @@ class YoloTest(object):
         os.mkdir(ground_truth_dir_path)
         os.mkdir(self.write_image_path)
 
-        with open(self.annotation_path, 'r') as annotation_file:
-            for num, line in enumerate(annotation_file):
-                annotation = line.strip().split()
-                image_path = annotation[0]
-                image_name = image_path.split('/')[-1]
-                image = cv2.imread(image_path)
-                bbox_data_gt = np.array([list(map(int, box.split(','))) for box in annotation[1:]])
-
-                if len(bbox_data_gt) == 0:
-                    bboxes_gt=[]
-                    classes_gt=[]
-                else:
-                    bboxes_gt, classes_gt = bbox_data_gt[:, :4], bbox_data_gt[:, 4]
-                ground_truth_path = os.path.join(ground_truth_dir_path, str(num) + '.txt')
-
-                print('=> ground truth of %s:' % image_name)
-                num_bbox_gt = len(bboxes_gt)
-                with open(ground_truth_path, 'w') as f:
-                    for i in range(num_bbox_gt):
-                        class_name = self.classes[classes_gt[i]]
-                        xmin, ymin, xmax, ymax = list(map(str, bboxes_gt[i]))
-                        bbox_mess = ' '.join([class_name, xmin, ymin, xmax, ymax]) + '\n'
-                        f.write(bbox_mess)
-                        print('\t' + str(bbox_mess).strip())
-                print('=> predict result of %s:' % image_name)
-                predict_result_path = os.path.join(predicted_dir_path, str(num) + '.txt')
-                bboxes_pr = self.predict(image)
-
-                if self.write_image:
-                    image = utils.draw_bbox(image, bboxes_pr, show_label=self.show_label)
-                    cv2.imwrite(self.write_image_path+image_name, image)
-
-                with open(predict_result_path, 'w') as f:
-                    for bbox in bboxes_pr:
-                        coor = np.array(bbox[:4], dtype=np.int32)
-                        score = bbox[4]
-                        class_ind = int(bbox[5])
-                        class_name = self.classes[class_ind]
-                        score = '%.4f' % score
-                        xmin, ymin, xmax, ymax = list(map(str, coor))
-                        bbox_mess = ' '.join([class_name, score, xmin, ymin, xmax, ymax]) + '\n'
-                        f.write(bbox_mess)
-                        print('\t' + str(bbox_mess).strip())
+        annotation_index = load_annotation_index(self.annotation_path)
+        for num in range(len(annotation_index)):
+            image_path = annotation_index.path(num)
+            image_name = image_path.split('/')[-1]
+            image, scale = self.read_image(image_path)
+            bbox_data_gt = annotation_index.bboxes(num)
+
+            if len(bbox_data_gt) == 0:
+                bboxes_gt=[]
+                classes_gt=[]
+            else:
+                bboxes_gt, classes_gt = bbox_data_gt[:, :4], bbox_data_gt[:, 4]
+            ground_truth_path = os.path.join(ground_truth_dir_path, str(num) + '.txt')
+
+            print('=> ground truth of %s:' % image_name)
+            num_bbox_gt = len(bboxes_gt)
+            with open(ground_truth_path, 'w') as f:
+                for i in range(num_bbox_gt):
+                    class_name = self.classes[classes_gt[i]]
+                    xmin, ymin, xmax, ymax = list(map(str, bboxes_gt[i]))
+                    bbox_mess = ' '.join([class_name, xmin, ymin, xmax, ymax]) + '\n'
+                    f.write(bbox_mess)
+                    print('\t' + str(bbox_mess).strip())
+            print('=> predict result of %s:' % image_name)
+            predict_result_path = os.path.join(predicted_dir_path, str(num) + '.txt')
+            bboxes_pr = self.predict(image, scale)
+
+            if self.write_image:
+                if scale != (1.0, 1.0): image = cv2.imread(image_path)
+                image = utils.draw_bbox(image, bboxes_pr, show_label=self.show_label)
+                cv2.imwrite(self.write_image_path+image_name, image)
+
+            with open(predict_result_path, 'w') as f:
+                for bbox in bboxes_pr:
+                    coor = np.array(bbox[:4], dtype=np.int32)
+                    score = bbox[4]
+                    class_ind = int(bbox[5])
+                    class_name = self.classes[class_ind]
+                    score = '%.4f' % score
+                    xmin, ymin, xmax, ymax = list(map(str, coor))
+                    bbox_mess = ' '.join([class_name, score, xmin, ymin, xmax, ymax]) + '\n'
+                    f.write(bbox_mess)
+                    print('\t' + str(bbox_mess).strip())
+        print('=> mean network time %.2f ms over %d images' % (1000. * np.mean(self.latencies), len(self.latencies)))
 
     def voc_2012_test(self, voc2012_test_path):
 
@@ -142,10 +200,10 @@ class YoloTest(object):
 
         for image_ind in image_inds:
             image_path = os.path.join(voc2012_test_path, 'JPEGImages', image_ind + '.jpg')
-            image = cv2.imread(image_path)
+            image, scale = self.read_image(image_path)
 
             print('predict result of %s:' % image_ind)
-            bboxes_pr = self.predict(image)
+            bboxes_pr = self.predict(image, scale)
             for bbox in bboxes_pr:
                 coor = np.array(bbox[:4], dtype=np.int32)
                 score = bbox[4]
@@ -159,4 +217,41 @@ class YoloTest(object):
                 print('\t' + str(bbox_mess).strip())
 
 
-if __name__ == '__main__': YoloTest().evaluate()
\ No newline at end of file
+class YoloTestTFLite(YoloTest):
+    """
+    YoloTest on the TFLite model TEST.TFLITE_FILE of quantize.py. the model returns the raw conv maps, which are
+    decoded here as in YOLOV3.decode, and it only runs at the square input size it was converted for
+    """
+    def load_model(self):
+
+        self.rect        = False
+        self.graph_nms   = False
+        self.uint8_input = False
+        self.strides     = np.array(cfg.YOLO.STRIDES)
+        self.interpreter = tf.lite.Interpreter(model_path=cfg.TEST.TFLITE_FILE)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        # the small stride head has the largest map
+        self.output_details = sorted(self.interpreter.get_output_details(), key=lambda detail: -detail['shape'][1])
+        self.input_size = int(self.input_detail['shape'][1])
+
+    def run_model(self, image_data):
+
+        if self.input_detail['dtype'] != np.float32:
+            scale, zero_point = self.input_detail['quantization']
+            info = np.iinfo(self.input_detail['dtype'])
+            image_data = np.clip(np.round(image_data / scale + zero_point), info.min, info.max)
+        self.interpreter.set_tensor(self.input_detail['index'], image_data.astype(self.input_detail['dtype']))
+        self.interpreter.invoke()
+
+        preds = []
+        for detail, anchors, stride in zip(self.output_details, self.anchors, self.strides):
+            conv_output = self.interpreter.get_tensor(detail['index'])
+            if detail['dtype'] != np.float32:
+                scale, zero_point = detail['quantization']
+                conv_output = (conv_output.astype(np.float32) - zero_point) * scale
+            preds.append(utils.decode_conv_output(conv_output, anchors, stride, self.num_classes, self.mobile))
+        return preds
+
+
+if __name__ == '__main__': (YoloTestTFLite if cfg.TEST.TFLITE_FILE else YoloTest)().evaluate()
\ No newline at end of file
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : fold_batchnorm.py
+#   Author      : YunYang1994
+#   Created date: 2019-04-03 10:12:45
+#   Description : export a checkpoint with the batch norms folded into the convolutions
+#
+#================================================================
+"""
+Every batch normalization after a convolution is an affine map at inference,
+
+    gamma * (conv(x, w) - mean) / sqrt(var + eps) + beta = conv(x, w * s) + (beta - mean * s),  s = gamma / sqrt(var + eps)
+
+so it is folded into the convolution weight and a bias. The folded checkpoint belongs to the graph built with
+YOLOV3(input_data, common.FOLDED_BN), which has no batch norm ops and no tf.cond on `trainable`. Predictions of
+both graphs are compared on random inputs before the checkpoint is saved
+
+    $ python fold_batchnorm.py --weight_file ./checkpoint/yolov3_test_loss=9.2099.ckpt-5 \\
+                               --output_file ./checkpoint/yolov3_folded.ckpt
+
+and evaluate.py runs the folded checkpoint with __C.TEST.FOLDED_BN = True.
+"""
+
+import os
+import argparse
+import numpy as np
+import tensorflow as tf
+import core.common as common
+from core.config import cfg
+from core.yolov3 import YOLOV3
+
+# the batch norm scopes under a convolution scope and their epsilon, see common.convolutional and
+# common.batch_normalization
+BN_SCOPES = [('batch_normalization', 1e-3), ('BatchNorm', 1e-5)]
+EMA_SUFFIX = '/ExponentialMovingAverage'
+
+
+class CheckpointValues(object):
+    """read the variables of a checkpoint, the moving averages of the trainable ones when they were saved"""
+    def __init__(self, weight_file, use_ema=True):
+        self.reader  = tf.train.NewCheckpointReader(weight_file)
+        self.use_ema = use_ema and any(name.endswith(EMA_SUFFIX) for name in self.reader.get_variable_to_shape_map())
+
+    def has(self, name):
+        return self.reader.has_tensor(name)
+
+    def get(self, name):
+        if self.use_ema and self.reader.has_tensor(name + EMA_SUFFIX):
+            return self.reader.get_tensor(name + EMA_SUFFIX)
+        return self.reader.get_tensor(name)
+
+    def batch_norm(self, scope):
+        """the scale and shift of the batch norm of the convolution in `scope`, None when it has none"""
+        for bn_scope, epsilon in BN_SCOPES:
+            prefix = scope + '/' + bn_scope + '/'
+            if not self.has(prefix + 'gamma'): continue
+            scale = self.get(prefix + 'gamma') / np.sqrt(self.get(prefix + 'moving_variance') + epsilon)
+            shift = self.get(prefix + 'beta') - self.get(prefix + 'moving_mean') * scale
+            return scale, shift
+        return None
+
+
+def folded_value(values, name, shape):
+    """value of the variable `name` of the folded graph"""
+    scope, var_name = os.path.dirname(name), os.path.basename(name)
+    batch_norm = values.batch_norm(scope)
+    if batch_norm is None:
+        return values.get(name)
+
+    scale, shift = batch_norm
+    if var_name == 'bias':
+        return shift
+    weight = values.get(name)
+    if var_name == 'depthwise_weights':
+        # (kh, kw, channels, 1), the output channel of a depthwise filter is its input channel
+        return weight * scale[np.newaxis, np.newaxis, :, np.newaxis]
+    return weight * scale
+
+
+def build_predictions(trainable, input_size, batch_size):
+
+    input_data = tf.placeholder(dtype=tf.float32, shape=(batch_size, input_size, input_size, 3), name='input_data')
+    model = YOLOV3(input_data, trainable)
+    return input_data, [model.pred_sbbox, model.pred_mbbox, model.pred_lbbox]
+
+
+def original_predictions(weight_file, use_ema, images):
+
+    with tf.Graph().as_default():
+        trainable = tf.placeholder(dtype=tf.bool, name='trainable')
+        input_data, predictions = build_predictions(trainable, images.shape[1], images.shape[0])
+        if use_ema:
+            saver = tf.train.Saver(tf.train.ExponentialMovingAverage(cfg.YOLO.MOVING_AVE_DECAY).variables_to_restore())
+        else:
+            saver = tf.train.Saver(tf.global_variables())
+        with tf.Session() as sess:
+            saver.restore(sess, weight_file)
+            return sess.run(predictions, feed_dict={input_data: images, trainable: False})
+
+
+def fold_batchnorm(weight_file, output_file, use_ema=True, input_size=None, batch_size=2, rtol=1e-3, atol=1e-3):
+    """
+    save the folded checkpoint of weight_file to output_file, after checking that both give the same predictions.
+    return the largest absolute difference of the predictions
+    """
+    input_size = cfg.TEST.INPUT_SIZE if input_size is None else input_size
+    values = CheckpointValues(weight_file, use_ema)
+    images = np.random.RandomState(0).uniform(size=(batch_size, input_size, input_size, 3)).astype(np.float32)
+
+    with tf.Graph().as_default():
+        input_data, predictions = build_predictions(common.FOLDED_BN, input_size, batch_size)
+        saver = tf.train.Saver(tf.global_variables())
+        with tf.Session() as sess:
+            for var in tf.global_variables():
+                var.load(folded_value(values, var.op.name, var.shape), sess)
+            folded = sess.run(predictions, feed_dict={input_data: images})
+
+            original = original_predictions(weight_file, values.use_ema, images)
+            max_diff = max(np.max(np.abs(a - b)) for a, b in zip(folded, original))
+            for a, b, name in zip(folded, original, ['pred_sbbox', 'pred_mbbox', 'pred_lbbox']):
+                if not np.allclose(a, b, rtol=rtol, atol=atol):
+                    raise RuntimeError("%s of the folded graph differs by up to %g from the original"
+                                       % (name, np.max(np.abs(a - b))))
+            saver.save(sess, output_file)
+    return max_diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weight_file", default=cfg.TEST.WEIGHT_FILE)
+    parser.add_argument("--output_file", default="./checkpoint/yolov3_folded.ckpt")
+    parser.add_argument("--no_ema", action='store_true', help="fold the raw weights instead of their moving averages")
+    parser.add_argument("--input_size", type=int, default=None, help="default: TEST.INPUT_SIZE")
+    flags = parser.parse_args()
+
+    max_diff = fold_batchnorm(flags.weight_file, flags.output_file, not flags.no_ema, flags.input_size)
+    print('=> folded checkpoint saved to %s, predictions differ by at most %g' % (flags.output_file, max_diff))
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : freeze_graph.py
+#   Author      : YunYang1994
+#   Created date: 2019-04-04 09:26:31
+#   Description : freeze the network for one (batch, input size) into a .pb
+#
+#================================================================
+"""
+The frozen graph has a static (batch, input size, input size, 3) input, so the cell grids of the heads are
+constants, and it is built for inference only, without the `trainable` placeholder. Freeze one .pb per size
+
+    $ python freeze_graph.py --weight_file ./checkpoint/yolov3_test_loss=9.2099.ckpt-5 --input_size 416
+    $ python freeze_graph.py --weight_file ./checkpoint/yolov3_test_loss=9.2099.ckpt-5 --input_size 544
+
+and load them with
+
+    return_tensors = utils.read_pb_return_tensors(graph, "./checkpoint/yolov3_416.pb", utils.FROZEN_RETURN_ELEMENTS)
+
+or keep all of them loaded side by side with utils.FrozenGraphs("./checkpoint/yolov3_%d.pb").
+
+With __C.YOLO.PRECISION = "float16" the float32 weights of the checkpoint are stored in the .pb as float16
+constants, the input and the predictions stay float32.
+"""
+
+import argparse
+import tensorflow as tf
+import core.utils as utils
+import core.common as common
+from core.config import cfg
+from core.yolov3 import YOLOV3
+
+
+def fold_half_casts(graph_def, output_names):
+    """
+    replace every cast of a float32 constant, read through identities, to float16 or bfloat16 by a constant of the
+    cast value, then drop the float32 constants no longer used
+    """
+    nodes = {node.name: node for node in graph_def.node}
+
+    def const_input(name):
+        node = nodes[name.split(':')[0]]
+        while node.op == 'Identity': node = nodes[node.input[0].split(':')[0]]
+        return node if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum else None
+
+    folded_graph_def = tf.GraphDef()
+    for node in graph_def.node:
+        const = const_input(node.input[0]) if node.op == 'Cast' else None
+        if const is None:
+            folded_graph_def.node.add().CopyFrom(node)
+            continue
+        dtype = tf.as_dtype(node.attr['DstT'].type)
+        value = tf.make_ndarray(const.attr['value'].tensor).astype(dtype.as_numpy_dtype)
+        folded_node = folded_graph_def.node.add()
+        folded_node.op, folded_node.name, folded_node.device = 'Const', node.name, node.device
+        folded_node.attr['dtype'].type = dtype.as_datatype_enum
+        folded_node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value, dtype=dtype))
+    return tf.graph_util.extract_sub_graph(folded_graph_def, output_names)
+
+
+def freeze_graph(weight_file, pb_file, input_size=None, batch_size=1, folded_bn=False):
+    """
+    freeze the checkpoint weight_file into pb_file for a batch of batch_size images of input_size.
+    with folded_bn the checkpoint is one of fold_batchnorm.py
+    """
+    input_size = cfg.TEST.INPUT_SIZE if input_size is None else input_size
+    output_names = [name.split(':')[0] for name in utils.FROZEN_RETURN_ELEMENTS[1:]]
+
+    with tf.Graph().as_default() as graph:
+        with tf.name_scope('input'):
+            input_data = tf.placeholder(dtype=tf.uint8 if cfg.YOLO.INPUT_UINT8 else tf.float32,
+                                        shape=(batch_size, input_size, input_size, 3), name='input_data')
+        model = YOLOV3(input_data, common.FOLDED_BN if folded_bn else False)
+        with tf.name_scope('output'):
+            for name, pred in zip(['pred_sbbox', 'pred_mbbox', 'pred_lbbox'],
+                                  [model.pred_sbbox, model.pred_mbbox, model.pred_lbbox]):
+                tf.identity(pred, name=name)
+
+        if folded_bn:
+            saver = tf.train.Saver(tf.global_variables())
+        else:
+            saver = tf.train.Saver(tf.train.ExponentialMovingAverage(cfg.YOLO.MOVING_AVE_DECAY).variables_to_restore())
+
+        with tf.Session(graph=graph) as sess:
+            saver.restore(sess, weight_file)
+            frozen_graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), output_names)
+        if cfg.YOLO.PRECISION != 'float32':
+            frozen_graph_def = fold_half_casts(frozen_graph_def, output_names)
+
+    with tf.gfile.GFile(pb_file, 'wb') as f:
+        f.write(frozen_graph_def.SerializeToString())
+    return len(frozen_graph_def.node)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weight_file", default=cfg.TEST.WEIGHT_FILE)
+    parser.add_argument("--pb_file", default=None, help="default: ./checkpoint/yolov3_<input_size>.pb")
+    parser.add_argument("--input_size", type=int, default=cfg.TEST.INPUT_SIZE)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--folded_bn", action='store_true', default=cfg.TEST.FOLDED_BN,
+                        help="weight_file is a checkpoint of fold_batchnorm.py")
+    flags = parser.parse_args()
+
+    pb_file = flags.pb_file or "./checkpoint/yolov3_%d.pb" % flags.input_size
+    num_nodes = freeze_graph(flags.weight_file, pb_file, flags.input_size, flags.batch_size, flags.folded_bn)
+    print('=> %d nodes frozen into %s' % (num_nodes, pb_file))
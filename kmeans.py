@@ -1,4 +1,5 @@
 import numpy as np
+from core.annotation import load_annotation_index
 
 
 class YOLO_Kmeans:
@@ -69,21 +70,9 @@ class YOLO_Kmeans:
         f.close()
 
     def txt2boxes(self):
-        f = open(self.filename, 'r')
-        dataSet = []
-        for line in f:
-            infos = line.split(" ")
-            length = len(infos)
-            if len(infos) == 1:
-                print(infos[1])
-            for i in range(1, length):
-                width = int(infos[i].split(",")[2]) - \
-                    int(infos[i].split(",")[0])
-                height = int(infos[i].split(",")[3]) - \
-                    int(infos[i].split(",")[1])
-                dataSet.append([width, height])
-        result = np.array(dataSet)
-        f.close()
+        boxes = np.array(load_annotation_index(self.filename).all_bboxes())
+        result = np.stack([boxes[:, 2] - boxes[:, 0],
+                           boxes[:, 3] - boxes[:, 1]], axis=-1)
         return result
 
     def txt2clusters(self):
@@ -0,0 +1,96 @@
+#! /usr/bin/env python
+# coding=utf-8
+#================================================================
+#   Copyright (C) 2019 * Ltd. All rights reserved.
+#
+#   Editor      : VIM
+#   File name   : quantize.py
+#   Author      : YunYang1994
+#   Created date: 2019-04-05 14:08:53
+#   Description : post training int8 quantization into a TFLite model
+#
+#================================================================
+"""
+Convert a checkpoint into a TFLite model with int8 weights and activations, calibrated on letterboxed images
+of TEST.ANNOT_PATH
+
+    $ python quantize.py --weight_file ./checkpoint/yolov3_test_loss=9.2099.ckpt-5 --tflite_file ./checkpoint/yolov3_int8.tflite
+
+The model stops at the raw conv maps of the three heads: decoded, the boxes (in pixels) and the probabilities
+would share one int8 scale. evaluate.py decodes them and evaluates the model with
+__C.TEST.TFLITE_FILE = "./checkpoint/yolov3_int8.tflite", printing the mean network time to compare with fp32.
+"""
+
+import cv2
+import argparse
+import numpy as np
+import tensorflow as tf
+import core.utils as utils
+import core.common as common
+from core.config import cfg
+from core.yolov3 import YOLOV3
+from core.annotation import load_annotation_index
+
+
+def representative_dataset(annot_path, input_size, num_images=200, seed=0):
+    """a generator of num_images random images of annot_path, letterboxed as YoloTest.predict does"""
+    annotation_index = load_annotation_index(annot_path)
+    lines = np.random.RandomState(seed).permutation(len(annotation_index))[:num_images]
+
+    def generator():
+        for line in lines:
+            image = cv2.imread(annotation_index.path(line))
+            if image is None: continue
+            image_data = utils.image_preporcess(image, [input_size, input_size])
+            yield [image_data[np.newaxis, ...].astype(np.float32)]
+    return generator
+
+
+def quantize(weight_file, tflite_file, input_size=None, num_images=200, folded_bn=False, uint8_io=True):
+    """
+    convert weight_file into a full integer TFLite model with a (1, input_size, input_size, 3) input.
+    with uint8_io the input and outputs are uint8 too, otherwise they stay float32
+    """
+    input_size = cfg.TEST.INPUT_SIZE if input_size is None else input_size
+
+    with tf.Graph().as_default() as graph:
+        input_data = tf.placeholder(dtype=tf.float32, shape=(1, input_size, input_size, 3), name='input_data')
+        model = YOLOV3(input_data, common.FOLDED_BN if folded_bn else False)
+
+        if folded_bn:
+            saver = tf.train.Saver(tf.global_variables())
+        else:
+            saver = tf.train.Saver(tf.train.ExponentialMovingAverage(cfg.YOLO.MOVING_AVE_DECAY).variables_to_restore())
+
+        with tf.Session(graph=graph) as sess:
+            saver.restore(sess, weight_file)
+            converter = tf.lite.TFLiteConverter.from_session(sess, [input_data],
+                                                             [model.conv_sbbox, model.conv_mbbox, model.conv_lbbox])
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = tf.lite.RepresentativeDataset(
+                representative_dataset(cfg.TEST.ANNOT_PATH, input_size, num_images))
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            if uint8_io:
+                converter.inference_input_type = tf.uint8
+                converter.inference_output_type = tf.uint8
+            tflite_model = converter.convert()
+
+    with open(tflite_file, 'wb') as f:
+        f.write(tflite_model)
+    return len(tflite_model)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--weight_file", default=cfg.TEST.WEIGHT_FILE)
+    parser.add_argument("--tflite_file", default="./checkpoint/yolov3_int8.tflite")
+    parser.add_argument("--input_size", type=int, default=cfg.TEST.INPUT_SIZE)
+    parser.add_argument("--num_images", type=int, default=200, help="calibration images drawn from TEST.ANNOT_PATH")
+    parser.add_argument("--folded_bn", action='store_true', default=cfg.TEST.FOLDED_BN,
+                        help="weight_file is a checkpoint of fold_batchnorm.py")
+    parser.add_argument("--float_io", action='store_true', help="keep a float32 input and outputs")
+    flags = parser.parse_args()
+
+    num_bytes = quantize(flags.weight_file, flags.tflite_file, flags.input_size, flags.num_images,
+                         flags.folded_bn, not flags.float_io)
+    print('=> %.1f MB int8 model saved to %s' % (num_bytes / 2. ** 20, flags.tflite_file))
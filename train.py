@@ -12,7 +12,9 @@
 #================================================================
 
 import os
+import glob
 import time
+import argparse
 import shutil
 import numpy as np
 import tensorflow as tf
@@ -37,28 +39,40 @@ class YoloTrain(object):
         self.second_stage_epochs = cfg.TRAIN.SECOND_STAGE_EPOCHS
         self.warmup_periods      = cfg.TRAIN.WARMUP_EPOCHS
         self.initial_weight      = cfg.TRAIN.INITIAL_WEIGHT
+        self.resume              = cfg.TRAIN.RESUME
+        self.save_steps          = cfg.TRAIN.SAVE_STEPS
+        self.graph_labels        = cfg.TRAIN.GRAPH_LABELS
+        self.precision           = cfg.YOLO.PRECISION
         self.time                = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime(time.time()))
         self.moving_ave_decay    = cfg.YOLO.MOVING_AVE_DECAY
         self.max_bbox_per_scale  = 150
         self.train_logdir        = "./data/log/train"
         self.trainset            = Dataset('train')
         self.testset             = Dataset('test')
-        self.steps_per_period    = len(self.trainset)
+        self.samples_per_period  = self.trainset.samples_per_epoch()
         self.sess                = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
         
         with tf.name_scope('define_input'):
-            self.input_data   = tf.placeholder(dtype=tf.float32, name='input_data')
-            self.label_sbbox  = tf.placeholder(dtype=tf.float32, name='label_sbbox')
-            self.label_mbbox  = tf.placeholder(dtype=tf.float32, name='label_mbbox')
-            self.label_lbbox  = tf.placeholder(dtype=tf.float32, name='label_lbbox')
-            self.true_sbboxes = tf.placeholder(dtype=tf.float32, name='sbboxes')
-            self.true_mbboxes = tf.placeholder(dtype=tf.float32, name='mbboxes')
-            self.true_lbboxes = tf.placeholder(dtype=tf.float32, name='lbboxes')
+            self.input_data   = tf.placeholder(dtype=tf.uint8 if cfg.YOLO.INPUT_UINT8 else tf.float32, name='input_data')
+            if self.graph_labels:
+                # only the padded boxes are fed, the labels are built on the device
+                self.gt_boxes = tf.placeholder(dtype=tf.float32, shape=[None, None, 5], name='gt_boxes')
+            else:
+                self.label_sbbox  = tf.placeholder(dtype=tf.float32, name='label_sbbox')
+                self.label_mbbox  = tf.placeholder(dtype=tf.float32, name='label_mbbox')
+                self.label_lbbox  = tf.placeholder(dtype=tf.float32, name='label_lbbox')
+                self.true_sbboxes = tf.placeholder(dtype=tf.float32, name='sbboxes')
+                self.true_mbboxes = tf.placeholder(dtype=tf.float32, name='mbboxes')
+                self.true_lbboxes = tf.placeholder(dtype=tf.float32, name='lbboxes')
             self.trainable     = tf.placeholder(dtype=tf.bool, name='training')
 
         with tf.name_scope("define_loss"):
             self.model = YOLOV3(self.input_data, self.trainable)
             self.net_var = tf.global_variables()
+            if self.graph_labels:
+                with tf.name_scope('build_labels'):
+                    self.label_sbbox, self.label_mbbox, self.label_lbbox, \
+                    self.true_sbboxes, self.true_mbboxes, self.true_lbboxes = self.model.build_labels(self.gt_boxes)
             self.giou_loss, self.conf_loss, self.prob_loss = self.model.compute_loss(
                                                         self.label_sbbox,  self.label_mbbox,  self.label_lbbox,
                                                         self.true_sbboxes, self.true_mbboxes, self.true_lbboxes)
@@ -69,22 +83,37 @@ class YoloTrain(object):
             self.loss = self.giou_loss + self.conf_loss + self.prob_loss
 
         with tf.name_scope('learn_rate'):
+            # the schedule follows the number of images seen, which stays right when the batch size
+            # changes with the input size
             self.global_step = tf.Variable(1.0, dtype=tf.float64, trainable=False, name='global_step')
-            warmup_steps = tf.constant(self.warmup_periods * self.steps_per_period,
-                                        dtype=tf.float64, name='warmup_steps')
-            train_steps = tf.constant( (self.first_stage_epochs + self.second_stage_epochs)* self.steps_per_period,
-                                        dtype=tf.float64, name='train_steps')
+            self.global_sample = tf.Variable(1.0 * self.trainset.batch_size, dtype=tf.float64, trainable=False,
+                                             name='global_sample')
+            warmup_samples = tf.constant(self.warmup_periods * self.samples_per_period,
+                                        dtype=tf.float64, name='warmup_samples')
+            train_samples = tf.constant( (self.first_stage_epochs + self.second_stage_epochs)* self.samples_per_period,
+                                        dtype=tf.float64, name='train_samples')
             self.learn_rate = tf.cond(
-                pred=self.global_step < warmup_steps,
-                true_fn=lambda: self.global_step / warmup_steps * self.learn_rate_init,
+                pred=self.global_sample < warmup_samples,
+                true_fn=lambda: self.global_sample / warmup_samples * self.learn_rate_init,
                 false_fn=lambda: self.learn_rate_end + 0.5 * (self.learn_rate_init - self.learn_rate_end) *
                                     (1 + tf.cos(
-                                        (self.global_step - warmup_steps) / (train_steps - warmup_steps) * np.pi))
+                                        (self.global_sample - warmup_samples) / (train_samples - warmup_samples) * np.pi))
             )
-            global_step_update = tf.assign_add(self.global_step, 1.0)
+            self.batch_samples = tf.cast(tf.shape(self.input_data)[0], tf.float64)
+
+        with tf.name_scope('loss_scale'):
+            # float16 gradients underflow, the loss is scaled up for the backward pass. bfloat16 has the
+            # exponent range of float32 and needs no scaling
+            self.loss_scale = None
+            if self.precision == 'float16':
+                self.loss_scale = tf.Variable(float(cfg.TRAIN.LOSS_SCALE), dtype=tf.float32, trainable=False,
+                                              name='loss_scale')
+                self.good_steps = tf.Variable(0, dtype=tf.int32, trainable=False, name='good_steps')
+                tf.summary.scalar("loss_scale", self.loss_scale)
 
         with tf.name_scope("define_weight_decay"):
-            moving_ave = tf.train.ExponentialMovingAverage(self.moving_ave_decay).apply(tf.trainable_variables())
+            self.moving_ave = tf.train.ExponentialMovingAverage(self.moving_ave_decay)
+            self.moving_ave_op = self.moving_ave.apply(tf.trainable_variables())
 
         with tf.name_scope("define_first_stage_train"):
             self.first_stage_trainable_var_list = []
@@ -94,22 +123,20 @@ class YoloTrain(object):
                 if var_name_mess[0] in ['conv_sbbox', 'conv_mbbox', 'conv_lbbox']:
                     self.first_stage_trainable_var_list.append(var)
 
-            first_stage_optimizer = tf.train.AdamOptimizer(self.learn_rate).minimize(self.loss,
-                                                      var_list=self.first_stage_trainable_var_list)
+            first_stage_optimizer = self.minimize(tf.train.AdamOptimizer(self.learn_rate),
+                                                  var_list=self.first_stage_trainable_var_list)
             with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-                with tf.control_dependencies([first_stage_optimizer, global_step_update]):
-                    with tf.control_dependencies([moving_ave]):
-                        self.train_op_with_frozen_variables = tf.no_op()
+                with tf.control_dependencies([first_stage_optimizer]):
+                    self.train_op_with_frozen_variables = tf.no_op()
 
         with tf.name_scope("define_second_stage_train"):
             second_stage_trainable_var_list = tf.trainable_variables()
-            second_stage_optimizer = tf.train.AdamOptimizer(self.learn_rate).minimize(self.loss,
-                                                      var_list=second_stage_trainable_var_list)
+            second_stage_optimizer = self.minimize(tf.train.AdamOptimizer(self.learn_rate),
+                                                   var_list=second_stage_trainable_var_list)
 
             with tf.control_dependencies(tf.get_collection(tf.GraphKeys.UPDATE_OPS)):
-                with tf.control_dependencies([second_stage_optimizer, global_step_update]):
-                    with tf.control_dependencies([moving_ave]):
-                        self.train_op_with_all_variables = tf.no_op()
+                with tf.control_dependencies([second_stage_optimizer]):
+                    self.train_op_with_all_variables = tf.no_op()
 
         with tf.name_scope('loader_and_saver'):
             self.loader = tf.train.Saver(self.net_var)
@@ -129,17 +156,97 @@ class YoloTrain(object):
             self.summary_writer  = tf.summary.FileWriter(logdir, graph=self.sess.graph)
 
 
+    def apply_step(self, optimizer, grads_and_vars, moving_average_update):
+        """apply the gradients, then count the step and its samples and update the moving averages"""
+        with tf.control_dependencies([optimizer.apply_gradients(grads_and_vars)]):
+            return tf.group(tf.assign_add(self.global_step, 1.0),
+                            tf.assign_add(self.global_sample, self.batch_samples),
+                            moving_average_update())
+
+    def moving_average_update(self):
+        """
+        the update of self.moving_ave_op built again in the current context. an op created outside a tf.cond
+        runs whatever the branch, so the skippable float16 step builds its own inside the branch
+        """
+        return tf.group(*[tf.assign_sub(self.moving_ave.average(var),
+                                        (self.moving_ave.average(var) - var) * (1 - self.moving_ave_decay))
+                          for var in tf.trainable_variables()])
+
+    def minimize(self, optimizer, var_list):
+        """
+        the train step of self.loss over var_list, see apply_step. with the dynamic loss scale of YOLO.PRECISION
+        float16 the gradients of the scaled loss are scaled back, a step whose gradients overflow skips the
+        weights, the optimizer slots, the step counters and the moving averages, and halves the scale, which doubles
+        again after TRAIN.LOSS_SCALE_PERIOD applied steps. the batch norm statistics (UPDATE_OPS) are updated by
+        the forward pass and still take such a step
+        """
+        if self.loss_scale is None:
+            grads_and_vars = optimizer.compute_gradients(self.loss, var_list=var_list)
+            return self.apply_step(optimizer, [(grad, var) for grad, var in grads_and_vars if grad is not None],
+                                   lambda: self.moving_ave_op)
+
+        grads_and_vars = optimizer.compute_gradients(self.loss * self.loss_scale, var_list=var_list)
+        grads_and_vars = [(grad / self.loss_scale, var) for grad, var in grads_and_vars if grad is not None]
+        finite = tf.reduce_all([tf.reduce_all(tf.is_finite(grad)) for grad, _ in grads_and_vars])
+        step_op = tf.cond(finite, lambda: self.apply_step(optimizer, grads_and_vars, self.moving_average_update),
+                          tf.no_op)
+
+        with tf.control_dependencies([step_op]):
+            good_steps = tf.where(finite, self.good_steps + 1, 0)
+            grow = good_steps >= cfg.TRAIN.LOSS_SCALE_PERIOD
+            loss_scale = tf.where(finite, tf.where(grow, self.loss_scale * 2., self.loss_scale),
+                                  tf.maximum(self.loss_scale / 2., 1.))
+            return tf.group(tf.assign(self.loss_scale, loss_scale),
+                            tf.assign(self.good_steps, tf.where(grow, 0, good_steps)))
+
+    def feed_dict(self, batch, trainable):
+
+        if self.graph_labels:
+            return {self.input_data: batch[0], self.gt_boxes: batch[1], self.trainable: trainable}
+        return {self.input_data:   batch[0],
+                self.label_sbbox:  batch[1],
+                self.label_mbbox:  batch[2],
+                self.label_lbbox:  batch[3],
+                self.true_sbboxes: batch[4],
+                self.true_mbboxes: batch[5],
+                self.true_lbboxes: batch[6],
+                self.trainable:    trainable}
+
+    def save_checkpoint(self, ckpt_file, global_step):
+        """save the variables and, next to them, the position of the train set iterator"""
+        ckpt_path = self.saver.save(self.sess, ckpt_file, global_step=global_step)
+        self.trainset.save_state(ckpt_path + '.iterator.npz')
+        for state_path in glob.glob(os.path.join(os.path.dirname(ckpt_path), '*.iterator.npz')):
+            if not os.path.exists(state_path[:-len('.iterator.npz')] + '.index'): os.remove(state_path)
+
     def train(self):
         self.sess.run(tf.global_variables_initializer())
-        try:
-            print('=> Restoring weights from: %s ... ' % self.initial_weight)
-            self.loader.restore(self.sess, self.initial_weight)
-        except:
-            print('=> %s does not exist !!!' % self.initial_weight)
-            print('=> Now it starts to train YOLOV3 from scratch ...')
-            self.first_stage_epochs = 0
-
-        for epoch in range(1, 1+self.first_stage_epochs+self.second_stage_epochs):
+        if self.resume:
+            print('=> Resuming training from: %s ... ' % self.resume)
+            # only the variables added since may be missing: the image count of an older checkpoint, and the
+            # loss scale of a run in another YOLO.PRECISION, which starts again from its initial value
+            optional_vars = [self.global_sample] + ([self.loss_scale, self.good_steps] if self.loss_scale is not None else [])
+            optional_names = [var.op.name for var in optional_vars]
+            reader = tf.train.NewCheckpointReader(self.resume)
+            missing_names = [var.op.name for var in tf.global_variables() if not reader.has_tensor(var.op.name)]
+            if set(missing_names) - set(optional_names):
+                raise ValueError("%s lacks the variables %s" % (
+                    self.resume, ', '.join(name for name in missing_names if name not in optional_names)))
+            tf.train.Saver([var for var in tf.global_variables() if var.op.name not in missing_names]).restore(
+                self.sess, self.resume)
+            if self.global_sample.op.name in missing_names:
+                self.global_sample.load(self.sess.run(self.global_step) * self.trainset.batch_size, self.sess)
+            self.trainset.load_state(self.resume + '.iterator.npz')
+        else:
+            try:
+                print('=> Restoring weights from: %s ... ' % self.initial_weight)
+                self.loader.restore(self.sess, self.initial_weight)
+            except:
+                print('=> %s does not exist !!!' % self.initial_weight)
+                print('=> Now it starts to train YOLOV3 from scratch ...')
+                self.first_stage_epochs = 0
+
+        for epoch in range(1+self.trainset.epoch, 1+self.first_stage_epochs+self.second_stage_epochs):
             if epoch <= self.first_stage_epochs:
                 train_op = self.train_op_with_frozen_variables
             else:
@@ -150,49 +257,40 @@ class YoloTrain(object):
 
             for train_data in pbar:
                 _, summary, train_step_loss, global_step_val = self.sess.run(
-                    [train_op, self.write_op, self.loss, self.global_step],feed_dict={
-                                                self.input_data:   train_data[0],
-                                                self.label_sbbox:  train_data[1],
-                                                self.label_mbbox:  train_data[2],
-                                                self.label_lbbox:  train_data[3],
-                                                self.true_sbboxes: train_data[4],
-                                                self.true_mbboxes: train_data[5],
-                                                self.true_lbboxes: train_data[6],
-                                                self.trainable:    True,
-                })
+                    [train_op, self.write_op, self.loss, self.global_step],
+                    feed_dict=self.feed_dict(train_data, True))
 
                 train_epoch_loss.append(train_step_loss)
                 self.summary_writer.add_summary(summary, global_step_val)
                 pbar.set_description("train loss: %.2f" %train_step_loss)
+                if self.save_steps > 0 and int(global_step_val) % self.save_steps == 0:
+                    self.save_checkpoint("./checkpoint/yolov3_Epoch=%04d_step.ckpt" % epoch, int(global_step_val))
 
             for test_data in self.testset:
-                test_step_loss = self.sess.run( self.loss, feed_dict={
-                                                self.input_data:   test_data[0],
-                                                self.label_sbbox:  test_data[1],
-                                                self.label_mbbox:  test_data[2],
-                                                self.label_lbbox:  test_data[3],
-                                                self.true_sbboxes: test_data[4],
-                                                self.true_mbboxes: test_data[5],
-                                                self.true_lbboxes: test_data[6],
-                                                self.trainable:    False,
-                })
+                test_step_loss = self.sess.run( self.loss, feed_dict=self.feed_dict(test_data, False))
 
                 test_epoch_loss.append(test_step_loss)
 
             train_epoch_loss, test_epoch_loss = np.mean(train_epoch_loss), np.mean(test_epoch_loss)
-<<<<<<< HEAD
             ckpt_file = "./checkpoint/yolov3_Epoch=%04d_test_loss=%.4f.ckpt" % (epoch, test_epoch_loss)
-=======
-            ckpt_file = "./checkpoint/yolov3_test_loss=%.4f.ckpt" % test_epoch_loss
->>>>>>> c0363a9e963142bc608a556e452c42f64669e145
             log_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
             print("=> Epoch: %2d Time: %s Train loss: %.2f Test loss: %.2f Saving %s ..."
                             %(epoch, log_time, train_epoch_loss, test_epoch_loss, ckpt_file))
-            self.saver.save(self.sess, ckpt_file, global_step=epoch)
+            self.save_checkpoint(ckpt_file, epoch)
 
+        self.trainset.close()
+        self.testset.close()
 
 
-if __name__ == '__main__': YoloTrain().train()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rank", type=int, default=int(os.environ.get('RANK', cfg.TRAIN.RANK)),
+                        help="shard of the train set of this trainer, default: $RANK of the launcher, else TRAIN.RANK")
+    parser.add_argument("--world_size", type=int, default=int(os.environ.get('WORLD_SIZE', cfg.TRAIN.WORLD_SIZE)),
+                        help="number of trainers, default: $WORLD_SIZE of the launcher, else TRAIN.WORLD_SIZE")
+    flags = parser.parse_args()
+    cfg.TRAIN.RANK, cfg.TRAIN.WORLD_SIZE = flags.rank, flags.world_size
+    YoloTrain().train()
 
 
 